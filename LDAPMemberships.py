@@ -43,21 +43,98 @@ def extend(list):
     ldap = LDAPMemberships(list)
     ldap.ldapsearch = "(uid=recipient)" # your LDAP search here (for regular members if digest enabled)
     ldap.ldapdigestsearch = None        # if digests are enabled, this search is for digest members.    
-    ldap.ldapserver = "ldap://ldap.example.net:389" # your LDAP server
+    ldap.ldapserver = "ldap://ldap.example.net:389" # your LDAP server, or a list of
+                                                    # replicas to choose from
     ldap.ldapbasedn = "dc=Example dc=net" # your base DN
     ldap.ldapbinddn = ''                 # bind DN that can access 'mail' field
     ldap.ldappasswd = ''                 # bind password for ldapbinddn
     ldap.ldaprefresh = 360      # OPTIONAL refresh time in seconds
+    ldap.ldapdigestrefresh = None # OPTIONAL refresh time of ldapdigestsearch in
+                                  # seconds, ldaprefresh if None
+    ldap.ldapbackgroundrefresh = False # OPTIONAL refresh in a background thread
+                                # and keep serving the previous members meanwhile
+    ldap.ldaprefreshwait = 0    # OPTIONAL seconds to wait for a background refresh
+    ldap.ldapsnapshot = False   # OPTIONAL share the members with other processes
+                                # through a snapshot file in the list directory
+    ldap.ldapincremental = None # OPTIONAL 'syncrepl' or 'timestamp' to only search
+                                # entries changed since the previous refresh.
+                                # Not available with ldapgroupattr.
+    ldap.ldapfullrefresh = 86400 # OPTIONAL seconds between full refreshes when
+                                 # refreshing incrementally
     ldap.ldaptls = False            # Use TLS, must be set to True or False
     ldap.ldapgroupattr = '' # if using groups, attribute that holds DN info.
                             # Omit or set to null string if not using groups.
+    ldap.ldapgroupexpansion = 'base' # OPTIONAL how member DNs of groups are resolved:
+                                     # 'base'     - one base search per DN,
+                                     # 'filter'   - OR-filters on ldapgroupdnattr
+                                     #              of ldapgroupchunksize DNs each,
+                                     # 'memberof' - subtree searches on ldapmemberofattr.
+    ldap.ldapgroupdnattr = 'entryDN' # OPTIONAL attribute holding the DN of an entry
+                                     # ('distinguishedName' for Active Directory).
+    ldap.ldapgroupchunksize = 100    # OPTIONAL number of DNs/groups per search.
+    ldap.ldapmemberofattr = 'memberOf' # OPTIONAL
+    ldap.ldapgroupcache = 0     # OPTIONAL seconds to cache resolved member DNs
+                                # across refreshes.  0 disables the cache.
     ldap.ldapmailattr = 'mail' # if you use a special attribute to keep user's mail address,
                                # set its name to this option.  Omit if you use the standard
                                # attribute, `mail'.
     ldap.ldapnameattr = 'gecos' # if you use a special attribute to keep user's name,
                                 # set its name to this option.  Omit if you use the standard
                                 # attribute.
+    ldap.ldaplazynames = False  # OPTIONAL only fetch mail attributes when refreshing,
+                                # and search names when they are needed
+    ldap.ldapnamecache = 10000  # OPTIONAL number of names cached with ldaplazynames
+    ldap.ldapnamettl = 3600     # OPTIONAL seconds names are cached
     ldap.ldapfilterfunction = None
+    ldap.ldapfilterrules = []   # OPTIONAL rules selecting the members, ANDed with the
+                                # searches when they can be expressed as LDAP filters:
+                                # [('exclude', 'employeeType', '=', 'contractor'),
+                                #  ('include', 'mail', '=', '*@example.net'),
+                                #  ('exclude', 'uid', '~', '^test')]
+                                # Operators are '=' (with * wildcards), '!=', '>=', '<=',
+                                # '>', '<', 'in' (with a list of values), 'present' (with
+                                # no value), and, applied locally, '~' (a regular
+                                # expression) or a function called with the values.
+    ldap.ldapextraattrs = []    # OPTIONAL extra attributes to fetch, e.g. for
+                                # use by ldapfilterfunction.  With ldapfilterfunction
+                                # and no ldapextraattrs, all attributes are fetched:
+                                # list the ones it reads to fetch only those.
+    ldap.ldappagesize = 1000    # OPTIONAL page size of the Simple Paged Results
+                                # control.  Set to 0 to disable paging.
+    ldap.ldapconcurrency = 4    # OPTIONAL number of searches run concurrently.
+                                # Searches run one at a time with python-ldap
+                                # releases older than 3.
+    ldap.ldapconnections = 2    # OPTIONAL number of connections to ldapserver
+                                # shared by the lists of a process
+    ldap.ldapnetworktimeout = 5 # OPTIONAL seconds to wait for a connection
+    ldap.ldaptimeout = 30       # OPTIONAL seconds to wait for an answer, or for a
+                                # free connection
+    ldap.ldaprefreshtimeout = 300 # OPTIONAL seconds a refresh may take in all
+    ldap.ldapbackoff = 10       # OPTIONAL seconds before retrying a failed server
+                                # or refresh, doubled for each failure of a server
+    ldap.ldapmaxbackoff = 600   # OPTIONAL
+    ldap.ldapmetrics = None     # OPTIONAL where to report the metrics of each refresh:
+                                # 'syslog'     - a summary line in the ldap log,
+                                # 'json'       - ldapmetrics.json in the list directory,
+                                # 'prometheus' - a textfile for the node exporter
+                                #                in ldapmetricsdir,
+                                # or a function called with the list name and
+                                # a dictionary of the metrics.
+    ldap.ldapmetricsdir = None  # OPTIONAL directory of the Prometheus textfiles,
+                                # the list directory by default
+    ldap.ldapdirectlookup = False # OPTIONAL when the members are not loaded or
+                                # expired, have isMember() search the address
+                                # alone instead of loading all the members.
+                                # Not available with ldapgroupattr.
+    ldap.ldaplookupcache = 10000 # OPTIONAL number of addresses cached with
+                                 # ldapdirectlookup
+    ldap.ldaplookupttl = 300    # OPTIONAL seconds members are cached
+    ldap.ldapnonmemberttl = 60  # OPTIONAL seconds non-members are cached
+    ldap.ldapjournal = False    # OPTIONAL append the members who joined and left
+                                # at each refresh to ldapmembers.journal in the
+                                # list directory (see getMemberChanges())
+    ldap.ldapjournalsize = 1048576 # OPTIONAL bytes after which the journal is
+                                   # rotated to ldapmembers.journal.1
     ldap.ldappersistentmembers = ['foo@example.net']
     list._memberadaptor = ldap
 ##########
@@ -120,172 +197,2257 @@ NEW IN 0.63 - changes from Seth Bromberger
         ldapdigestsearch represents an ldap query that is analogous to ldapsearch, but for digest members.
         If set to None, no digests will be sent.
         
+NEW IN 0.64
+    Searches request only the attributes that are used (see ldapextraattrs;
+        all of them with an ldapfilterfunction and no ldapextraattrs)
+        and are retrieved with the Simple Paged Results control, one page of
+        ldappagesize entries at a time.
+    The digest search really uses ldapdigestsearch.
+    Member DNs of groups can be resolved in bulk (see ldapgroupexpansion).
+        DNs shared between groups are resolved only once, nested groups are
+        expanded with cycle detection, and resolved DNs can be cached for
+        ldapgroupcache seconds across refreshes.
+    The regular search, the digest search and the group expansions run
+        asynchronously, with up to ldapconcurrency searches outstanding.
+    Members are loaded into a new snapshot which replaces the previous one
+        only when it is complete.  With ldapbackgroundrefresh, expired
+        snapshots are refreshed in a background thread and keep being
+        served in the meantime.
+    With ldapsnapshot, members are saved to a snapshot file in the list
+        directory, from which other processes load them while they are
+        younger than ldaprefresh instead of searching the directory.
+    With ldapincremental, refreshes only search the entries which changed
+        since the previous one, using RFC 4533 content synchronization
+        ('syncrepl', refreshOnly) or modifyTimestamp ('timestamp', also
+        used when the server does not support content synchronization).
+        Deletions are only noticed by the full refresh every
+        ldapfullrefresh seconds with 'timestamp'.
+    Lists of the same process which make the same search with the same
+        settings share its result and its refreshes, and lists using the
+        same server and bind DN share a pool of ldapconnections connections.
+    ldapserver may be a list of replicas.  The one with the shortest
+        round-trip time, measured by binds and searches, is used, and
+        failed servers are retried after a growing backoff.  Connections,
+        searches, waits for a free connection and whole refreshes (see
+        ldaprefreshtimeout) time out, dropped connections are reopened,
+        and the previous members, or an expired snapshot, keep being served
+        while no server answers.
+    Refreshes and lookups are instrumented (see ldapmetrics): the time
+        spent in each phase of a refresh, the LDAP operations, entries and
+        bytes it took, the groups it expanded, and the lookups, stale
+        lookups and lookups of non-members are reported after each refresh.
+    Each member is held once, in arrays rebuilt by each refresh, and found
+        through a single index of its addresses in lowercase, which are
+        interned.  A member found by both the regular and the digest
+        search only receives digests.
+    With ldaplazynames, refreshes do not fetch the names of members, which
+        are searched in batches when needed and kept in a cache of
+        ldapnamecache names for ldapnamettl seconds.  The rules of mm_cfg
+        for building names are looked up once per list.
+    Members are looked up in bulk by getMemberCPAddresses(), and by the
+        areMembers() and getMemberNames() extensions, which work on a
+        single snapshot.  getMemberCPAddresses() returns None for
+        non-members instead of raising NotAMemberError, as documented.
+    ldapfilterrules select members declaratively.  The rules which can be
+        are added to the LDAP filters of the searches, so that the entries
+        they drop are not transferred, and the others are applied to each
+        page of entries received.
+    Group attributes truncated by Active Directory (MaxValRange) are
+        retrieved range after range, and the member DNs of each range are
+        resolved as soon as it arrives.
+    refreshMembers() refreshes the members whatever their age, and returns
+        those who joined and left.  bin/ldap_members uses it to warm the
+        snapshots of lists from cron, in parallel, and to dump and diff
+        their members.
+    With ldapjournal, the members who joined and left at each refresh are
+        appended to a journal in the list directory, which is rotated after
+        ldapjournalsize bytes and read by getMemberChanges().  Use it with
+        ldapsnapshot, otherwise each process journals the changes it sees.
+    The regular and digest searches are refreshed apart, after ldaprefresh
+        and ldapdigestrefresh seconds, and only the digest search is
+        refreshed by getDigestMemberKeys().  Snapshot files keep the result
+        of each search.
+    With ldapdirectlookup, isMember() does not load all the members when
+        they are not loaded or expired, but searches the address alone, in
+        both the regular and digest searches, and keeps the answer in a
+        cache of ldaplookupcache addresses for ldaplookupttl seconds, or
+        ldapnonmemberttl seconds for non-members.
+
 """
 
-VERSION = 0.63
+VERSION = 0.64
 
 from Mailman.Logging.Syslog import syslog
 from Mailman import MemberAdaptor
 import mm_cfg
 import ldap
+import ldap.dn
+import ldap.filter
+from ldap.controls import SimplePagedResultsControl
+try:
+    from ldap.syncrepl import SyncRequestControl, SyncStateControl, \
+         SyncDoneControl, SyncInfoMessage
+except ImportError:
+    # python-ldap without pyasn1
+    SyncRequestControl = None
+import os
+import re
+import sys
 import time
+import marshal
+import hashlib
+import itertools
+import threading
+import weakref
+try:
+    import json
+except ImportError:
+    import simplejson as json
 from Errors import *
 
 DEBUG = False
 
+# name and format version of the membership snapshot in the list directory
+SNAPSHOT_FILE = 'ldapmembers.snapshot'
+SNAPSHOT_VERSION = 6
+
+# name of the metrics file in the list directory
+METRICS_FILE = 'ldapmetrics.json'
+
+# name of the journal of membership changes in the list directory, which
+# is rotated to JOURNAL_FILE.1
+JOURNAL_FILE = 'ldapmembers.journal'
+
+# attributes which may be used to build the name of a member
+NAME_ATTRS = ('sn', 'preferredname', 'givenname', 'fullname', 'cn')
+
+# number of members whose names are searched at once with ldaplazynames
+NAME_BATCH = 100
+
+def _filter(filterstr):
+    # a search filter enclosed in parentheses, to combine it with others
+    if filterstr.startswith('('):
+        return filterstr
+    return '(%s)' % filterstr
+
+def _dnkey(dn):
+    # normalized form of a DN, used to compare DNs
+    try:
+        return ldap.dn.dn2str(ldap.dn.str2dn(dn)).lower()
+    except ldap.DECODING_ERROR:
+        return dn.lower()
+
+def _group_values(attrs, attr):
+    # The values of the group attribute attr of an entry, or None, and the
+    # start of the next range of values when Active Directory returned only
+    # a range of them ("attr;range=0-1499"), None after the last range.
+    if attrs.has_key(attr):
+        return attrs[attr], None
+    prefix = attr.lower() + ';range='
+    for (name, values) in attrs.items():
+        if name.lower().startswith(prefix):
+            high = name[len(prefix):].split('-')[-1]
+            if high == '*':
+                return values, None
+            return values, int(high) + 1
+    return None
+
+def _rule_value(value):
+    # an assertion value, in which '*' is a wildcard
+    return '*'.join([ldap.filter.escape_filter_chars(part)
+                     for part in value.split('*')])
+
+def _compile_rules(rules):
+    """Compile the rules of ldapfilterrules.
+
+    Return the filter which keeps the entries selected by the rules which
+    can be expressed as LDAP filters (None if there are none), the other
+    rules as (include, attribute, test) tuples, and the attributes these
+    need.
+    """
+    fragments = []
+    local = []
+    attrs = []
+    for rule in rules:
+        if len(rule) == 3:
+            (action, attr, op), value = rule, None
+        else:
+            (action, attr, op, value) = rule
+        if action not in ('include', 'exclude'):
+            raise ValueError('Unknown filter rule action: %r' % (action,))
+        if op == '~' or callable(op):
+            if op == '~':
+                regex = re.compile(value)
+                test = lambda values, regex=regex: \
+                       [v for v in values if regex.search(v)] != []
+            else:
+                test = op
+            local.append((action == 'include', attr, test))
+            if attr not in attrs:
+                attrs.append(attr)
+            continue
+        if op == 'present':
+            fragment = '(%s=*)' % attr
+        elif op == '=':
+            fragment = '(%s=%s)' % (attr, _rule_value(value))
+        elif op == '!=':
+            fragment = '(!(%s=%s))' % (attr, _rule_value(value))
+        elif op in ('>=', '<='):
+            fragment = '(%s%s%s)' % (attr, op,
+                                     ldap.filter.escape_filter_chars(value))
+        elif op in ('>', '<'):
+            value = ldap.filter.escape_filter_chars(value)
+            fragment = '(&(%s%s=%s)(!(%s=%s)))' % (attr, op, value,
+                                                   attr, value)
+        elif op == 'in':
+            fragment = '(|%s)' % ''.join(['(%s=%s)' % (attr, _rule_value(v))
+                                          for v in value])
+        else:
+            raise ValueError('Unknown filter rule operator: %r' % (op,))
+        if action == 'exclude':
+            fragment = '(!%s)' % fragment
+        fragments.append(fragment)
+    if not fragments:
+        filterstr = None
+    elif len(fragments) == 1:
+        filterstr = fragments[0]
+    else:
+        filterstr = '(&%s)' % ''.join(fragments)
+    return filterstr, local, attrs
+
+def _apply_rules(local, entries):
+    # keep the entries selected by the local rules, one rule at a time
+    for (include, attr, test) in local:
+        entries = [(dn, attrs) for (dn, attrs) in entries
+                   if (not not test(attrs.get(attr, []))) == include]
+    return entries
+
+class _Search:
+    """A search submitted to a _SearchPipeline."""
+
+    def __init__(self, base, scope, filterstr, attrlist, callback, done,
+                 intermediate, serverctrls, pagesize, paged):
+        self.base = base
+        self.scope = scope
+        self.filterstr = filterstr
+        self.attrlist = attrlist
+        self.callback = callback
+        self.done = done
+        self.intermediate = intermediate
+        self.serverctrls = serverctrls
+        self.controls = serverctrls is not None
+        self.entries = []
+        # when the operation was sent, until its first answer
+        self.sent = None
+        self.ctrl = None
+        if ( pagesize and paged and scope != ldap.SCOPE_BASE
+             and not serverctrls ):
+            # not critical: servers without paging answer in one piece,
+            # without a cookie, which ends the search
+            self.ctrl = SimplePagedResultsControl(False, size=pagesize,
+                                                  cookie='')
+
+def _reports_msgids():
+    # whether python-ldap reports the message id of a failed operation,
+    # which tells which of several outstanding searches failed
+    try:
+        return int(ldap.__version__.split('.')[0]) >= 3
+    except (AttributeError, ValueError):
+        return False
+
+_REPORTS_MSGIDS = _reports_msgids()
+
+class _SearchPipeline:
+    """Run searches asynchronously over one connection.
+
+    Up to `concurrency' searches are outstanding at once (only one with
+    python-ldap releases older than 3, whose errors do not tell which
+    search failed), and ldap.TIMEOUT is raised if nothing is received for
+    `timeout' seconds, or once the time is past `deadline'.  The entries
+    of each page are handed to the callback of their search as soon as the
+    page is complete, and `done' is called with False if the base of the
+    search does not exist, True otherwise, and the controls of the result.
+    Callbacks may submit further searches.
+
+    Servers such as slapd keep the state of a single paged search per
+    connection, so paged searches run one after the other, while other
+    searches overlap them.  Searches which are known to return less than
+    a page are not paged.
+
+    With `controls', the entries of searches made with server controls are
+    (dn, attrs, ctrls) tuples, and intermediate messages are handed to the
+    `intermediate' callback of their search.
+
+    The operations sent and the entries received are counted in `stats',
+    a _RefreshStats, if given, and the time each operation takes to be
+    answered is reported to `server', a _ServerState, if given.
+    """
+
+    def __init__(self, l, concurrency, pagesize, timeout=None,
+                 controls=False, stats=None, server=None, deadline=None):
+        self.__conn = l
+        self.stats = stats
+        self.__server = server
+        self.__deadline = deadline
+        if not _REPORTS_MSGIDS:
+            concurrency = 1
+        self.__concurrency = max(1, concurrency)
+        self.__pagesize = pagesize
+        self.__timeout = timeout or -1
+        self.__controls = controls
+        self.__queue = []
+        self.__outstanding = {}
+        # the paged search in progress, until its last page is received
+        self.__paging = None
+
+    def search(self, base, scope, filterstr, attrlist, callback, done=None,
+               intermediate=None, serverctrls=None, paged=True):
+        self.__queue.append(_Search(base, scope, filterstr, attrlist,
+                                    callback, done, intermediate,
+                                    serverctrls, self.__pagesize, paged))
+
+    def run(self):
+        try:
+            while self.__queue or self.__outstanding:
+                while len(self.__outstanding) < self.__concurrency:
+                    op = self.__next()
+                    if op is None:
+                        break
+                    self.__submit(op)
+                self.__receive()
+        except:
+            for msgid in self.__outstanding.keys():
+                try:
+                    self.__conn.abandon(msgid)
+                except ldap.LDAPError:
+                    pass
+            self.__outstanding = {}
+            self.__queue = []
+            self.__paging = None
+            raise
+
+    def __next(self):
+        # the first queued search which can be sent now
+        for (i, op) in enumerate(self.__queue):
+            if op.ctrl is None:
+                return self.__queue.pop(i)
+            if self.__paging is None:
+                self.__paging = op
+                return self.__queue.pop(i)
+        return None
+
+    def __submit(self, op):
+        if op.ctrl:
+            serverctrls = [op.ctrl]
+        else:
+            serverctrls = op.serverctrls
+        op.sent = time.time()
+        msgid = self.__conn.search_ext(op.base, op.scope, op.filterstr,
+                                       op.attrlist, serverctrls=serverctrls)
+        self.__outstanding[msgid] = op
+        if self.stats:
+            self.stats.operations += 1
+
+    def __receive(self):
+        timeout = self.__timeout
+        if self.__deadline is not None:
+            left = self.__deadline - time.time()
+            if left <= 0:
+                raise ldap.TIMEOUT({'desc': 'Searches took too long'})
+            if timeout < 0 or left < timeout:
+                timeout = left
+        try:
+            if self.__controls:
+                rtype, rdata, rmsgid, rctrls = self.__conn.result4(
+                    ldap.RES_ANY, 0, timeout, add_ctrls=1,
+                    add_intermediates=1)[:4]
+            else:
+                rtype, rdata, rmsgid, rctrls = self.__conn.result3(
+                    ldap.RES_ANY, 0, timeout)
+        except ldap.NO_SUCH_OBJECT as e:
+            op = self.__outstanding.pop(self.__failed_msgid(e))
+            if op is self.__paging:
+                self.__paging = None
+            if op.done:
+                op.done(False, [])
+            return
+        op = self.__outstanding[rmsgid]
+        if op.sent is not None:
+            # the first answer to the operation
+            if self.__server:
+                self.__server.measured(time.time() - op.sent)
+            op.sent = None
+        if rtype == ldap.RES_INTERMEDIATE:
+            if op.intermediate:
+                op.intermediate(rdata)
+            return
+        if rtype != ldap.RES_SEARCH_RESULT:
+            if self.__controls and not op.controls:
+                rdata = [(entry[0], entry[1]) for entry in rdata]
+            op.entries.extend(rdata)
+            if self.stats:
+                self.stats.received(rdata)
+            return
+        del self.__outstanding[rmsgid]
+        entries, op.entries = op.entries, []
+        if entries:
+            op.callback(entries)
+        if op.ctrl:
+            op.ctrl.cookie = None
+            for c in rctrls:
+                if c.controlType == SimplePagedResultsControl.controlType:
+                    op.ctrl.cookie = c.cookie
+            if op.ctrl.cookie:
+                self.__submit(op)
+                return
+            self.__paging = None
+        if op.done:
+            op.done(True, rctrls)
+
+    def __failed_msgid(self, e):
+        # python-ldap 3 reports the message id of a failed operation;
+        # with a single outstanding operation there is no doubt anyway.
+        if len(self.__outstanding) == 1:
+            return self.__outstanding.keys()[0]
+        if e.args and isinstance(e.args[0], dict) \
+                and self.__outstanding.has_key(e.args[0].get('msgid')):
+            return e.args[0]['msgid']
+        raise e
+
+class _RefreshStats:
+    """What one refresh of a list did, for its metrics."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.duration = None
+        # where the members came from: 'ldap', 'shared' (searched by
+        # another list), 'snapshot', or 'previous' (kept after a failure)
+        self.source = None
+        self.phases = {}
+        self.operations = 0
+        self.entries = 0
+        self.bytes = 0
+        self.groups = 0
+        self.dncachehits = 0
+        self.error = None
+        # keys of the members who joined and left, if delta is set
+        self.delta = False
+        self.added = None
+        self.removed = None
+
+    def phase(self, name, start):
+        # add the time elapsed since start to a phase, and return the time
+        now = time.time()
+        self.phases[name] = self.phases.get(name, 0) + now - start
+        return now
+
+    def received(self, entries):
+        # bytes are those of the DNs, attribute names and values
+        for entry in entries:
+            if entry[0] is None:
+                continue
+            self.entries += 1
+            size = len(entry[0])
+            for (name, values) in entry[1].items():
+                size += len(name)
+                for value in values:
+                    size += len(value)
+            self.bytes += size
+
+class _Metrics:
+    """Counters of the lookups and refreshes of a list in this process,
+    and the statistics of its last refresh."""
+
+    def __init__(self):
+        self.lookups = 0
+        self.stale = 0
+        self.nonmembers = 0
+        self.namehits = 0
+        self.namemisses = 0
+        self.directhits = 0
+        self.directmisses = 0
+        self.refreshes = 0
+        self.failures = 0
+        self.last = None
+
+def _delta(old, new):
+    # the keys of the members of store new who are not in store old, and
+    # the other way round, sorted
+    if old is new:
+        return [], []
+    oldkeys = set(old.keys)
+    newkeys = set(new.keys)
+    added = list(newkeys - oldkeys)
+    removed = list(oldkeys - newkeys)
+    added.sort()
+    removed.sort()
+    return added, removed
+
+def _prometheus(record):
+    # the metrics of a list in the Prometheus text exposition format
+    listlabel = 'list="%s"' % record['list'].replace(
+        '\\', '\\\\').replace('"', '\\"')
+    lines = []
+    def metric(name, kind, text, samples):
+        # samples are (extra labels, value) pairs
+        lines.append('# HELP mailman_ldap_%s %s' % (name, text))
+        lines.append('# TYPE mailman_ldap_%s %s' % (name, kind))
+        for (labels, value) in samples:
+            lines.append('mailman_ldap_%s{%s%s} %r'
+                         % (name, listlabel, labels, float(value)))
+    phases = record['phases'].items()
+    phases.sort()
+    metric('refresh_timestamp_seconds', 'gauge',
+           'Time of the last refresh.', [('', record['time'])])
+    metric('refresh_duration_seconds', 'gauge',
+           'Duration of the last refresh.', [('', record['duration'])])
+    metric('refresh_phase_seconds', 'gauge',
+           'Time spent in each phase of the last refresh.',
+           [(',phase="%s"' % phase, seconds) for (phase, seconds) in phases])
+    metric('refresh_failed', 'gauge', 'Whether the last refresh failed.',
+           [('', record['error'] is not None)])
+    for (name, text) in (
+            ('operations', 'LDAP operations sent by the last refresh.'),
+            ('entries', 'Entries received by the last refresh.'),
+            ('bytes', 'Bytes of DNs and attributes received by the last'
+                      ' refresh.'),
+            ('groups', 'Groups expanded by the last refresh.'),
+            ('dncachehits', 'Member DNs of groups found in the cache by the'
+                            ' last refresh.')):
+        metric('refresh_' + name, 'gauge', text, [('', record[name])])
+    metric('members', 'gauge', 'Members, by delivery mode.',
+           [(',delivery="regular"', record['members']),
+            (',delivery="digest"', record['digestmembers'])])
+    metric('addresses', 'gauge',
+           'Addresses of the members, including alternate ones.',
+           [('', record['addresses'])])
+    metric('members_age_seconds', 'gauge', 'Age of the members served.',
+           [('', record['age'])])
+    for (name, text) in (
+            ('lookups', 'Lookups of the members.'),
+            ('stale', 'Lookups served from expired members.'),
+            ('nonmembers', 'Lookups of addresses which are not members.'),
+            ('namehits', 'Names found in the cache with ldaplazynames.'),
+            ('namemisses', 'Names searched with ldaplazynames.'),
+            ('directhits', 'Addresses found in the cache with'
+                           ' ldapdirectlookup.'),
+            ('directmisses', 'Addresses searched with ldapdirectlookup.'),
+            ('refreshes', 'Refreshes of the members.'),
+            ('failures', 'Refreshes which failed.')):
+        metric(name + '_total', 'counter', text, [('', record[name])])
+    return '\n'.join(lines) + '\n'
+
+def _intern(s):
+    # only plain strings can be interned
+    if type(s) is str:
+        return intern(s)
+    return s
+
+class _MemberStore:
+    """The members of a list, or found by a search.
+
+    Each member is held once, at a position in parallel arrays: `keys'
+    (its address in lowercase), `addresses' (as found in the directory)
+    and `names' (or None).  `digest' holds the positions of the members
+    which receive digests.  `index' maps every address of a member, in
+    lowercase, to its position.  Keys and addresses in lowercase are
+    interned, so that each is held once whatever refers to it.
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.addresses = []
+        self.names = []
+        self.digest = set()
+        self.index = {}
+
+    def __position(self, key):
+        # the position of the member with this key, added if needed
+        pos = self.index.get(key)
+        if pos is None or self.keys[pos] != key:
+            pos = len(self.keys)
+            self.keys.append(key)
+            self.addresses.append(None)
+            self.names.append(None)
+            self.index[key] = pos
+        return pos
+
+    def __alias(self, alias, pos):
+        # the address of a member is never taken over by an alias of
+        # another one
+        old = self.index.get(alias)
+        if old is None or self.keys[old] != alias:
+            self.index[alias] = pos
+
+    def add(self, address, aliases, name=None, digest=False):
+        # A member added again keeps its delivery mode and takes the new
+        # address, and the new name unless there is none.
+        pos = self.__position(_intern(address.lower()))
+        self.addresses[pos] = address
+        if name is not None:
+            self.names[pos] = name
+        if digest:
+            self.digest.add(pos)
+        for alias in aliases:
+            self.__alias(_intern(alias), pos)
+        return pos
+
+    def update(self, other, digest=False):
+        # add the members of another store, with the given delivery mode
+        positions = []
+        for i in range(len(other.keys)):
+            pos = self.__position(other.keys[i])
+            self.addresses[pos] = other.addresses[i]
+            self.names[pos] = other.names[i]
+            if digest:
+                self.digest.add(pos)
+            else:
+                self.digest.discard(pos)
+            positions.append(pos)
+        for (alias, i) in other.index.items():
+            self.__alias(alias, positions[i])
+
+    def copy(self):
+        store = _MemberStore()
+        store.keys = self.keys[:]
+        store.addresses = self.addresses[:]
+        store.names = self.names[:]
+        store.digest = set(self.digest)
+        store.index = self.index.copy()
+        return store
+
+    def remove(self, keys):
+        # Members are removed with every alias pointing to them, and the
+        # last members moved to the positions left, the others keeping
+        # theirs.
+        holes = set()
+        for key in keys:
+            pos = self.index.get(key)
+            if pos is not None and self.keys[pos] == key:
+                holes.add(pos)
+        if not holes:
+            return
+        end = len(self.keys) - len(holes)
+        moved = dict(zip([pos for pos in range(end, len(self.keys))
+                          if pos not in holes],
+                         sorted([pos for pos in holes if pos < end])))
+        for (old, new) in moved.items():
+            self.keys[new] = self.keys[old]
+            self.addresses[new] = self.addresses[old]
+            self.names[new] = self.names[old]
+        del self.keys[end:]
+        del self.addresses[end:]
+        del self.names[end:]
+        self.digest = set([moved.get(pos, pos) for pos in self.digest
+                           if pos not in holes])
+        for (alias, pos) in [(alias, pos)
+                             for (alias, pos) in self.index.iteritems()
+                             if pos >= end or pos in holes]:
+            if pos in holes:
+                del self.index[alias]
+            else:
+                self.index[alias] = moved[pos]
+
+    def count(self):
+        return len(self.keys)
+
+    def regular_keys(self):
+        if not self.digest:
+            return self.keys[:]
+        return [self.keys[pos] for pos in range(len(self.keys))
+                if pos not in self.digest]
+
+    def digest_keys(self):
+        return [self.keys[pos] for pos in sorted(self.digest)]
+
+    def get(self, address):
+        # the position of the member with this address, or None
+        return self.index.get(address.lower())
+
+    def dump(self):
+        # the store as data for marshal; keys are rebuilt from addresses
+        aliases = {}
+        for (alias, pos) in self.index.items():
+            if alias != self.keys[pos]:
+                aliases[alias] = pos
+        return (self.addresses, self.names, list(self.digest), aliases)
+
+    def load(self, data):
+        self.addresses, self.names, digest, aliases = data
+        self.keys = [_intern(address.lower()) for address in self.addresses]
+        self.digest = set(digest)
+        self.index = dict(zip(self.keys, range(len(self.keys))))
+        for (alias, pos) in aliases.items():
+            self.index[_intern(alias)] = pos
+
+class _LRUCache:
+    """At most `size' values, such as the names of members, each kept for
+    `ttl' seconds, the least recently used dropped first."""
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.__lock = threading.Lock()
+        # key -> [previous, next, key, expire, value], in a circular list
+        # from the most recently used to the least recently used
+        self.__links = {}
+        self.__root = []
+        self.__root[:] = [self.__root, self.__root, None, None, None]
+
+    def get(self, key):
+        # (True, value) if the value of key is cached, (False, None) if not
+        self.__lock.acquire()
+        try:
+            link = self.__links.get(key)
+            if link is None:
+                return False, None
+            self.__unlink(link)
+            if link[3] <= time.time():
+                del self.__links[key]
+                return False, None
+            self.__link(link)
+            return True, link[4]
+        finally:
+            self.__lock.release()
+
+    def put(self, key, value, ttl=None):
+        # keep value for ttl seconds instead of self.ttl, if given
+        if ttl is None:
+            ttl = self.ttl
+        self.__lock.acquire()
+        try:
+            link = self.__links.get(key)
+            if link is not None:
+                self.__unlink(link)
+            link = [None, None, key, time.time() + ttl, value]
+            self.__links[key] = link
+            self.__link(link)
+            while len(self.__links) > self.size:
+                oldest = self.__root[0]
+                self.__unlink(oldest)
+                del self.__links[oldest[2]]
+        finally:
+            self.__lock.release()
+
+    def __link(self, link):
+        root = self.__root
+        link[0] = root
+        link[1] = root[1]
+        root[1][0] = link
+        root[1] = link
+
+    def __unlink(self, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+
+class _Membership:
+    """A snapshot of the membership of a list.
+
+    A snapshot is completely built before it replaces the previous one,
+    and is not modified afterwards.
+    """
+
+    def __init__(self, updatetimes):
+        # when each search was made, and when the oldest one was
+        self.updatetimes = updatetimes
+        self.updatetime = min(updatetimes)
+        self.store = _MemberStore()
+
+class _EntryTable:
+    """The entries found by one search, kept for incremental refreshes.
+
+    Entries are keyed by their entryUUID with syncrepl and by their
+    normalized DN otherwise, and map to the key of the member made from
+    them, or None.  `refs' counts the entries making each member, and
+    `result' is the result built from the table.  A refresh collects the
+    entries it finds, or None for deleted ones, in `changes' of a copy of
+    the table, which replaces the previous one once complete.
+    """
+
+    def __init__(self, fulltime):
+        self.fulltime = fulltime
+        self.entries = {}
+        self.refs = {}
+        self.cookie = None
+        self.timestamp = None
+        self.result = None
+        self.changes = {}
+
+    def copy(self):
+        # entries and refs are shared until the changes are applied
+        table = _EntryTable(self.fulltime)
+        table.entries = self.entries
+        table.refs = self.refs
+        table.cookie = self.cookie
+        table.timestamp = self.timestamp
+        table.result = self.result
+        return table
+
+class _QueryResult:
+    """The members found by one search.
+
+    Like a _Membership, a result is not modified once it is complete.
+    """
+
+    def __init__(self, updatetime):
+        self.updatetime = updatetime
+        self.store = _MemberStore()
+
+class _SharedQuery:
+    """A search shared by all the lists of the process which make it with
+    the same settings, and the state kept between its refreshes."""
+
+    def __init__(self, key):
+        self.key = key
+        self.lock = threading.Lock()
+        self.result = None
+        self.table = None
+        self.dn_cache = {}
+        # the LDAPMemberships making the search
+        self.users = weakref.WeakKeyDictionary()
+
+class _ConnectionPool:
+    """At most `size' connections to a server, bound as the same DN.
+
+    ldap.TIMEOUT is raised if none is free within the timeout given to
+    acquire, rather than waiting behind long refreshes.
+    """
+
+    def __init__(self, size):
+        self.__size = size
+        self.__cond = threading.Condition()
+        self.__idle = []
+        self.__count = 0
+
+    def acquire(self, connect, timeout=None):
+        # return a connection, and whether it was used before
+        self.__cond.acquire()
+        try:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while not self.__idle and self.__count >= self.__size:
+                if timeout is None:
+                    self.__cond.wait()
+                    continue
+                left = deadline - time.time()
+                if left <= 0:
+                    raise ldap.TIMEOUT({'desc': 'No free connection'})
+                self.__cond.wait(left)
+            if self.__idle:
+                return self.__idle.pop(), True
+            self.__count += 1
+        finally:
+            self.__cond.release()
+        try:
+            return connect(), False
+        except:
+            self.__discard()
+            raise
+
+    def release(self, l, broken=False):
+        if broken:
+            try:
+                l.unbind_s()
+            except ldap.LDAPError:
+                pass
+            self.__discard()
+            return
+        self.__cond.acquire()
+        try:
+            self.__idle.append(l)
+            self.__cond.notify()
+        finally:
+            self.__cond.release()
+
+    def __discard(self):
+        self.__cond.acquire()
+        try:
+            self.__count -= 1
+            self.__cond.notify()
+        finally:
+            self.__cond.release()
+
+class _ServerState:
+    """The health of a server, as seen by all the lists of the process."""
+
+    def __init__(self):
+        self.rtt = None
+        self.failures = 0
+        self.retrytime = 0
+
+    def measured(self, rtt):
+        # exponentially weighted moving average of round-trip times
+        if self.rtt is None:
+            self.rtt = rtt
+        else:
+            self.rtt = 0.7 * self.rtt + 0.3 * rtt
+
+    def succeeded(self):
+        self.failures = 0
+        self.retrytime = 0
+
+    def failed(self, backoff, maxbackoff):
+        self.failures += 1
+        self.retrytime = time.time() + min(maxbackoff,
+                                           backoff * 2 ** (self.failures - 1))
+
+# Searches, connection pools and server states shared by all the lists of
+# the process
+_registry_lock = threading.Lock()
+_queries = {}
+_pools = {}
+_servers = {}
+
+def _shared_query(key, user):
+    _registry_lock.acquire()
+    try:
+        query = _queries.get(key)
+        if query is None:
+            # forget the searches which no list makes any more, such as
+            # those of lists loaded again by Mailman
+            for (oldkey, old) in _queries.items():
+                if not old.users:
+                    del _queries[oldkey]
+            query = _queries[key] = _SharedQuery(key)
+        query.users[user] = True
+        return query
+    finally:
+        _registry_lock.release()
+
+def _function_key(function):
+    # What a function does, rather than the function itself, which is new
+    # each time Mailman runs extend.py again: its code, and the values of
+    # its defaults, closure and globals.
+    code = getattr(function, 'func_code', None)
+    if code is None:
+        return function
+    closure = [cell.cell_contents for cell in function.func_closure or ()]
+    names = []
+    for name in code.co_names:
+        value = function.func_globals.get(name)
+        # functions it calls by their code too
+        names.append(getattr(value, 'func_code', None) or repr(value))
+    return (code, repr(function.func_defaults), repr(closure),
+            tuple(names))
+
+def _server_state(uri):
+    _registry_lock.acquire()
+    try:
+        if not _servers.has_key(uri):
+            _servers[uri] = _ServerState()
+        return _servers[uri]
+    finally:
+        _registry_lock.release()
+
+def _connection_pool(key, size):
+    _registry_lock.acquire()
+    try:
+        if not _pools.has_key(key):
+            _pools[key] = _ConnectionPool(size)
+        return _pools[key]
+    finally:
+        _registry_lock.release()
+
+class _GroupExpansion:
+    """State of the group expansion of one search."""
+
+    def __init__(self, query, result, attrlist):
+        self.query = query
+        self.result = result
+        self.attrlist = attrlist
+        # group DNs already expanded and member DNs already resolved
+        self.expanded = {}
+        self.resolved = {}
+
 class LDAPMemberships(MemberAdaptor.MemberAdaptor):
     """Readable-only LDAP-search-based memberships."""
 
     def __init__(self, mlist):
         self.__mlist = mlist
         self.__mlist.bounce_processing = False
-        self.__ldap_conn = None
-        self.__digestmembers = None
-        self.__regularmembers = None
-        self.__member_map = {}
-        self.__member_names = {}
-        self.__updatetime = None
+        self.__membership = None
+        self.__snapshot_mtime = None
+        self.__syncrepl_supported = SyncRequestControl is not None
+        self.__refresh_lock = threading.Lock()
+        self.__refresh_thread = None
+        self.__thread_lock = threading.Lock()
+        self.__retrytime = 0
+        self.__metrics = _Metrics()
+        self.__name_format = None
+        self.__name_cache = None
+        self.__lookup_cache = None
+        self.__rules = None
+        self.__rules_source = None
         self.ldaprefresh = 360
+        self.ldapdigestrefresh = None
+        self.ldapbackgroundrefresh = False
+        self.ldaprefreshwait = 0
+        self.ldapsnapshot = False
+        self.ldapincremental = None
+        self.ldapfullrefresh = 86400
         self.ldaptls = False
         self.ldapgroupattr = None
+        self.ldapgroupexpansion = 'base'
+        self.ldapgroupdnattr = 'entryDN'
+        self.ldapgroupchunksize = 100
+        self.ldapmemberofattr = 'memberOf'
+        self.ldapgroupcache = 0
         self.ldapmailattr = 'mail'
         self.ldapnameattr = None
+        self.ldaplazynames = False
+        self.ldapnamecache = 10000
+        self.ldapnamettl = 3600
         self.ldapdigestsearch = None
         self.ldapfilterfunction = None
+        self.ldapfilterrules = []
+        self.ldapextraattrs = []
+        self.ldappagesize = 1000
+        self.ldapconcurrency = 4
+        self.ldapconnections = 2
+        self.ldapnetworktimeout = 5
+        self.ldaptimeout = 30
+        self.ldaprefreshtimeout = 300
+        self.ldapbackoff = 10
+        self.ldapmaxbackoff = 600
+        self.ldapmetrics = None
+        self.ldapmetricsdir = None
+        self.ldapdirectlookup = False
+        self.ldaplookupcache = 10000
+        self.ldaplookupttl = 300
+        self.ldapnonmemberttl = 60
+        self.ldapjournal = False
+        self.ldapjournalsize = 1048576
         self.ldappersistentmembers = []
 
     #
     # LDAP utility functions
     #
-    def __ldap_bind(self):
-        if not self.__ldap_conn:
-            l = ldap.initialize(self.ldapserver)
-            if self.ldaptls:
-                l.start_tls_s()
-            l.simple_bind_s(self.ldapbinddn, self.ldappasswd)
-            self.__ldap_conn = l
-        return self.__ldap_conn
-
-    def __loadmembers(self, result, is_digest=False):
-        if not is_digest:
-            for mail in self.ldappersistentmembers:
-                lce = mail.lower()
-                self.__member_map[lce] = mail
-                self.__regularmembers[lce] = mail
+    def __ldap_servers(self):
+        if isinstance(self.ldapserver, basestring):
+            return self.ldapserver.split()
+        return list(self.ldapserver)
+
+    def __ldap_servers_by_preference(self):
+        # the fastest servers first, then those known to be down, the
+        # earliest to be retried first
+        now = time.time()
+        up = []
+        down = []
+        for uri in self.__ldap_servers():
+            state = _server_state(uri)
+            if state.retrytime <= now:
+                # servers not measured yet are tried first, to measure them
+                up.append((state.rtt or 0, len(up), uri))
+            else:
+                down.append((state.retrytime, len(down), uri))
+        up.sort()
+        down.sort()
+        return [uri for (rtt, i, uri) in up] + [uri for (t, i, uri) in down]
+
+    def __ldap_bind(self, uri):
+        start = time.time()
+        l = ldap.initialize(uri)
+        l.set_option(ldap.OPT_NETWORK_TIMEOUT, self.ldapnetworktimeout)
+        l.set_option(ldap.OPT_TIMEOUT, self.ldaptimeout)
+        l.timeout = self.ldaptimeout
+        if self.ldaptls:
+            l.start_tls_s()
+        l.simple_bind_s(self.ldapbinddn, self.ldappasswd)
+        _server_state(uri).measured(time.time() - start)
+        return l
+
+    def __ldap_pool(self, uri):
+        return _connection_pool((uri, self.ldapbinddn, self.ldappasswd,
+                                 self.ldaptls),
+                                self.ldapconnections)
+
+    def __ldap_attrlist(self):
+        attrlist = [self.ldapmailattr, 'mailalternateaddress']
+        if self.ldapgroupattr:
+            attrlist.append(self.ldapgroupattr)
+        if not self.ldaplazynames:
+            attrlist.extend(self.__ldap_name_attrlist())
+        attrlist.extend(self.__filter_rules()[2])
+        attrlist.extend(self.ldapextraattrs)
+        if self.ldapfilterfunction and not self.ldapextraattrs:
+            # the attributes the function reads are not known
+            attrlist.append('*')
+        return attrlist
+
+    def __ldap_name_attrlist(self):
+        attrlist = []
+        if self.ldapnameattr:
+            attrlist.append(self.ldapnameattr)
+        attrlist.extend(NAME_ATTRS)
+        return attrlist
+
+    def __loadpersistentmembers(self, membership):
+        for mail in self.ldappersistentmembers:
+            membership.store.add(mail, ())
+
+    def __filter_rules(self):
+        # ldapfilterrules compiled, again if they were changed
+        if self.__rules is None or self.__rules_source != self.ldapfilterrules:
+            self.__rules = _compile_rules(self.ldapfilterrules)
+            self.__rules_source = list(self.ldapfilterrules)
+        return self.__rules
+
+    def __rules_key(self, byname=False):
+        # the rules, with functions by name, and unless byname is set for
+        # keys which outlive the process, by what they do, since lambdas
+        # share their name
+        rules = []
+        functions = []
+        for rule in self.ldapfilterrules:
+            rule = list(rule)
+            if callable(rule[2]):
+                functions.append(_function_key(rule[2]))
+                rule[2] = getattr(rule[2], '__name__', None)
+            rules.append(tuple(rule))
+        if byname:
+            return repr(rules)
+        return (repr(rules), tuple(functions))
+
+    def __ldap_filter(self, filterstr):
+        # filterstr restricted to the entries kept by the rules which can
+        # be expressed as LDAP filters; groups are kept to be expanded
+        rulesfilter = self.__filter_rules()[0]
+        if rulesfilter is None:
+            return filterstr
+        if self.ldapgroupattr:
+            rulesfilter = '(|(%s=*)%s)' % (self.ldapgroupattr, rulesfilter)
+        return '(&%s%s)' % (_filter(filterstr), rulesfilter)
+
+    def __loadmembers(self, target, result):
+        for member in self.__members(result):
+            if member is not None:
+                target.store.add(*member)
+
+    def __members(self, result):
+        # the (address, aliases, name) of the member made from each entry,
+        # or None for the entries making none
+        local = self.__filter_rules()[1]
         for (dn, attrs) in result:
+            if local and not _apply_rules(local, [(dn, attrs)]):
+                yield None
+                continue
             if self.ldapfilterfunction:
                 if self.ldapfilterfunction(dn, attrs):
+                    yield None
                     continue
-            if attrs.has_key(self.ldapmailattr):
+            if not attrs.has_key(self.ldapmailattr):
+                yield None
+            else:
                 # first mail is special
                 mail = attrs[self.ldapmailattr][0].strip()
-                lce = mail.lower()
-                if is_digest:
-                    self.__digestmembers[lce] = mail
-                else:
-                    self.__regularmembers[lce] = mail
                 if DEBUG:
-                    syslog('debug','adding members[lce] = %s' % mail)
+                    syslog('debug','adding member %s' % mail)
                 # mail can have multiple values -- the_olo
-                for maddr in attrs[self.ldapmailattr]:
-                    self.__member_map[maddr.strip().lower()] = mail
+                aliases = [maddr.strip().lower()
+                           for maddr in attrs[self.ldapmailattr]]
                 if attrs.has_key('mailalternateaddress'):
                     malts = attrs['mailalternateaddress']
                     for malt in malts:
-                        self.__member_map[malt.lower()] = mail
-                if self.ldapnameattr and attrs.has_key(self.ldapnameattr):
-                    attrname = attrs[self.ldapnameattr][0]
-                    self.__member_names[lce] = attrname
-                elif attrs.has_key('sn'):
-                    # if a surname is defined, use it
-                    surname = attrs['sn'][0]
-                    try:
-                        sep = mm_cfg.LDAP_DEFAULT_SEPARATOR
-                    except AttributeError:
-                        sep = ' '
-                    if attrs.has_key('preferredname'):
-                        # use the preferred name if available
-                        tmp_name = attrs['preferredname'][0]
-                    elif attrs.has_key('givenname'):
-                        # or use the given name if not
-                        tmp_name = attrs['givenname'][0]
+                        aliases.append(malt.lower())
+                name = None
+                if not self.ldaplazynames:
+                    name = self.__member_name(attrs)
+                yield (mail, aliases, name)
+
+    def __member_name(self, attrs):
+        if self.__name_format is None:
+            self.__name_format = self.__compile_name_format()
+        return self.__name_format(attrs)
+
+    def __compile_name_format(self):
+        # The rules of mm_cfg are looked up once, and the function which
+        # applies them to the attributes of an entry is returned.
+        nameattr = self.ldapnameattr
+        try:
+            sep = mm_cfg.LDAP_DEFAULT_SEPARATOR
+        except AttributeError:
+            sep = ' '
+        try:
+            default_given = mm_cfg.LDAP_DEFAULT_GIVENNAME
+        except AttributeError:
+            default_given = ''
+        try:
+            surname_first = mm_cfg.LDAP_SURNAME_FIRST
+        except AttributeError:
+            surname_first = False
+        def name(attrs):
+            if nameattr and attrs.has_key(nameattr):
+                return attrs[nameattr][0]
+            elif attrs.has_key('sn'):
+                # if a surname is defined, use it
+                surname = attrs['sn'][0]
+                if attrs.has_key('preferredname'):
+                    # use the preferred name if available
+                    tmp_name = attrs['preferredname'][0]
+                elif attrs.has_key('givenname'):
+                    # or use the given name if not
+                    tmp_name = attrs['givenname'][0]
+                else:
+                    # or 'Unknown' if neither are defined
+                    tmp_name = default_given
+                # build the name
+                if surname_first:
+                    return surname + sep + tmp_name
+                return tmp_name + sep + surname
+            elif attrs.has_key('fullname'):
+                # since no surname, use full name if defined
+                return attrs['fullname'][0]
+            elif attrs.has_key('cn'):
+                # no surname and no full name, use the cn as the name
+                return attrs['cn'][0]
+            return None
+        return name
+
+    def __ldap_load_members(self, digest=False):
+        # With digest, only the digest members are looked up, and the
+        # regular search is not refreshed.
+        self.__metrics.lookups += 1
+        membership = self.__membership
+        if membership is None:
+            return self.__ldap_refresh(digest=digest)
+        now = time.time()
+        if self.__expired(membership, digest, now):
+            if self.__retrytime <= now:
+                if not self.ldapbackgroundrefresh:
+                    membership = self.__ldap_refresh(digest=digest)
+                else:
+                    self.__ldap_refresh_background()
+                    membership = self.__membership
+            if self.__expired(membership, digest, now):
+                self.__metrics.stale += 1
+        return membership
+
+    def __refresh_times(self):
+        # seconds the result of each search is kept
+        if not self.ldapdigestsearch:
+            return [self.ldaprefresh]
+        if self.ldapdigestrefresh is None:
+            return [self.ldaprefresh, self.ldaprefresh]
+        return [self.ldaprefresh, self.ldapdigestrefresh]
+
+    def __expired(self, membership, digest, now):
+        # the searches of membership which are older than their refresh
+        # time, among the digest search if digest is set, or all of them
+        expired = []
+        for (i, (updatetime, refresh)) in enumerate(
+                zip(membership.updatetimes, self.__refresh_times())):
+            if digest and i != 1:
+                continue
+            if updatetime + refresh < now:
+                expired.append(i)
+        return expired
+
+    def __ldap_refresh(self, force=False, stats=None, digest=False):
+        self.__refresh_lock.acquire()
+        try:
+            # another thread may have refreshed while we were waiting
+            membership = self.__membership
+            now = time.time()
+            if ( (not force) and (membership is not None)
+                 and ( (not self.__expired(membership, digest, now))
+                       or (self.__retrytime > now) ) ):
+                return membership
+            if stats is None:
+                stats = _RefreshStats()
+            try:
+                return self.__ldap_refresh_members(membership, stats, force,
+                                                   digest)
+            except:
+                if stats.error is None:
+                    stats.error = sys.exc_info()[1]
+                raise
+            finally:
+                self.__refreshed(stats)
+        finally:
+            self.__refresh_lock.release()
+
+    def __ldap_refresh_members(self, membership, stats, force, digest):
+        snapshot = None
+        if self.ldapsnapshot:
+            start = time.time()
+            snapshot = self.__load_snapshot()
+            stats.phase('snapshot', start)
+            if ( (not force) and (snapshot is not None)
+                 and (not self.__expired(snapshot, digest, time.time()))
+                 and ( (membership is None)
+                       or (max(snapshot.updatetimes)
+                           > max(membership.updatetimes)) ) ):
+                stats.source = 'snapshot'
+                self.__membership = snapshot
+                return snapshot
+        # the last members we know of, even an old snapshot
+        previous = membership
+        if previous is None or (snapshot is not None and
+                snapshot.updatetime > previous.updatetime):
+            previous = snapshot
+        queries = self.__ldap_queries()
+        # Refresh the searches which are too old, or only the digest one
+        # with digest.  Searches which another list refreshed since a forced
+        # refresh started will do.
+        now = time.time()
+        since = []
+        for (i, refresh) in enumerate(self.__refresh_times()):
+            if force:
+                since.append(stats.start)
+            elif digest and i != 1:
+                since.append(None)
+            else:
+                since.append(now - refresh)
+        try:
+            self.__ldap_refresh_queries(queries, stats, since)
+        except ldap.LDAPError as e:
+            # keep serving them while the directory is unavailable
+            stats.error = e
+            self.__retrytime = time.time() + self.ldapbackoff
+            if previous is None:
+                raise
+            syslog('error', 'Refreshing members of %s failed,'
+                   ' keeping the previous ones: %s'
+                   % (self.__mlist.internal_name(), e))
+            stats.source = 'previous'
+            self.__membership = previous
+            return previous
+        if stats.operations:
+            stats.source = 'ldap'
+        else:
+            stats.source = 'shared'
+        start = time.time()
+        results = [query.result for query in queries]
+        membership = self.__merge(results)
+        self.__membership = membership
+        start = stats.phase('merge', start)
+        journal = self.ldapjournal and previous is not None
+        if stats.delta or journal:
+            oldstore = _MemberStore()
+            if previous is not None:
+                oldstore = previous.store
+            added, removed = _delta(oldstore, membership.store)
+            if journal and (added or removed):
+                # before saving the snapshot, so that no change is lost
+                self.__write_journal(added, removed)
+            if stats.delta:
+                stats.added, stats.removed = added, removed
+            start = stats.phase('delta', start)
+        if self.ldapsnapshot:
+            self.__save_snapshot(results, queries)
+            stats.phase('save', start)
+        return membership
+
+    def __merge(self, results):
+        # build the membership of the list from the results of its searches
+        membership = _Membership([result.updatetime for result in results])
+        if not self.ldappersistentmembers and len(results) == 1:
+            # nothing to add, share the store of the result
+            membership.store = results[0].store
+            return membership
+        self.__loadpersistentmembers(membership)
+        membership.store.update(results[0].store)
+        if len(results) > 1:
+            # members found by both searches receive digests
+            membership.store.update(results[1].store, digest=True)
+        return membership
+
+    #
+    # Searches shared by lists with the same settings
+    #
+    def __ldap_queries(self):
+        # the regular search, and the digest search if any
+        queries = [self.__ldap_query(self.__ldap_filter(self.ldapsearch))]
+        if self.ldapdigestsearch:
+            queries.append(self.__ldap_query(
+                self.__ldap_filter(self.ldapdigestsearch)))
+        return queries
+
+    def __ldap_query(self, filterstr):
+        # everything which makes a difference to the members found
+        filterfunction = self.ldapfilterfunction
+        if filterfunction is not None:
+            filterfunction = _function_key(filterfunction)
+        return _shared_query((
+            tuple(self.__ldap_servers()), self.ldapbinddn, self.ldapbasedn,
+            filterstr,
+            tuple(self.__ldap_attrlist()), self.ldapgroupattr,
+            self.ldapgroupexpansion, self.ldapgroupdnattr,
+            self.ldapmemberofattr, self.ldapincremental, self.ldapmailattr,
+            self.ldapnameattr, filterfunction, self.__rules_key()), self)
+
+    def __ldap_refresh_queries(self, queries, stats, since):
+        # Refresh the searches which were never made, and those made before
+        # their time in since, if it is not None.  Those which another list
+        # is refreshing are waited for, and refreshed here only if they are
+        # still too old afterwards.
+        locked = []
+        try:
+            for query in sorted(queries, key=id):
+                if query not in locked:
+                    query.lock.acquire()
+                    locked.append(query)
+            stale = []
+            for (query, oldest) in zip(queries, since):
+                if query in stale:
+                    continue
+                if ( (query.result is None)
+                     or ( (oldest is not None)
+                          and (query.result.updatetime < oldest) ) ):
+                    stale.append(query)
+            if stale:
+                self.__ldap_search_queries(stale, stats)
+        finally:
+            for query in locked:
+                query.lock.release()
+
+    def __ldap_search_queries(self, queries, stats):
+        deadline = None
+        if self.ldaprefreshtimeout:
+            deadline = stats.start + self.ldaprefreshtimeout
+        self.__ldap_failover(
+            lambda l, server: self.__ldap_search_connection(
+                l, server, queries, stats, deadline), deadline)
+
+    def __ldap_failover(self, search, deadline=None):
+        # Call search with a connection to the fastest server which is not
+        # known to be down and its _ServerState, and fail over to the
+        # other ones until the deadline.
+        servers = self.__ldap_servers_by_preference()
+        if not servers:
+            raise ldap.SERVER_DOWN({'desc': 'No LDAP server in ldapserver'
+                                            ' for %s'
+                                            % self.__mlist.internal_name()})
+        error = None
+        for uri in servers:
+            if error is not None and deadline is not None \
+                    and deadline <= time.time():
+                break
+            state = _server_state(uri)
+            try:
+                self.__ldap_search_server(uri, state, search)
+            except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.TIMEOUT) as e:
+                state.failed(self.ldapbackoff, self.ldapmaxbackoff)
+                syslog('error', 'LDAP server %s failed for %s: %s'
+                       % (uri, self.__mlist.internal_name(), e))
+                error = e
+                continue
+            state.succeeded()
+            return
+        raise error
+
+    def __ldap_search_server(self, uri, state, search):
+        pool = self.__ldap_pool(uri)
+        while True:
+            l, reused = pool.acquire(lambda: self.__ldap_bind(uri),
+                                     self.ldaptimeout or None)
+            try:
+                search(l, state)
+            except ldap.SERVER_DOWN:
+                pool.release(l, broken=True)
+                if reused:
+                    # the server may just have dropped an idle connection
+                    continue
+                raise
+            except:
+                pool.release(l, broken=True)
+                raise
+            pool.release(l)
+            return
+
+    def __ldap_search_connection(self, l, server, queries, stats, deadline):
+        syncrepl = (self.ldapincremental == 'syncrepl'
+                    and self.__syncrepl_supported)
+        pipeline = _SearchPipeline(l, self.ldapconcurrency, self.ldappagesize,
+                                   self.ldaptimeout, controls=syncrepl,
+                                   stats=stats, server=server,
+                                   deadline=deadline)
+        finish = []
+        for query in queries:
+            if self.ldapincremental and not self.ldapgroupattr:
+                finish.append(self.__ldap_search_incremental(
+                    pipeline, query, syncrepl))
+            else:
+                finish.append(self.__ldap_load_members2(pipeline, query))
+        start = time.time()
+        try:
+            pipeline.run()
+        except (ldap.UNAVAILABLE_CRITICAL_EXTENSION,
+                ldap.PROTOCOL_ERROR) as e:
+            if not syncrepl:
+                raise
+            syslog('warn', 'Content synchronization is not available'
+                   ' for %s, using modifyTimestamp instead: %s'
+                   % (self.__mlist.internal_name(), e))
+            self.__syncrepl_supported = False
+            for query in queries:
+                # entries keyed by entryUUID are of no use any more
+                query.table = None
+            return self.__ldap_search_connection(l, server, queries, stats,
+                                                 deadline)
+        finally:
+            start = stats.phase('search', start)
+        for (query, result) in zip(queries, finish):
+            query.result = result()
+        stats.phase('build', start)
+
+    #
+    # Incremental refreshes
+    #
+    def __ldap_search_incremental(self, pipeline, query, syncrepl):
+        # Only the entries changed since the previous refresh are searched,
+        # and applied to a copy of the entry table and of the result of
+        # the query, which replace them once the search is complete: a
+        # search made again after a failure starts from the same table.
+        # The table is rebuilt from scratch every ldapfullrefresh seconds.
+        now = time.time()
+        table = query.table
+        if ( table is None or table.result is None
+             or table.fulltime + self.ldapfullrefresh < now ):
+            table = _EntryTable(now)
+        else:
+            table = table.copy()
+        filterstr = query.key[3]
+        if syncrepl:
+            self.__ldap_syncrepl(pipeline, table, filterstr)
+        else:
+            self.__ldap_timestamp_delta(pipeline, table, filterstr)
+        def finish():
+            self.__apply_changes(table, now)
+            query.table = table
+            return table.result
+        return finish
+
+    def __apply_changes(self, table, now):
+        # The members made only from changed entries are removed from the
+        # previous result, and those made from the entries found added.
+        # Until the next full refresh, an alias shared with another member
+        # may be lost with it.
+        result = _QueryResult(now)
+        if table.result is not None:
+            result.store = table.result.store.copy()
+        entries = table.entries.copy()
+        refs = table.refs.copy()
+        removed = []
+        for entrykey in table.changes.keys():
+            key = entries.pop(entrykey, None)
+            if key is None:
+                continue
+            refs[key] -= 1
+            if not refs[key]:
+                del refs[key]
+                removed.append(key)
+        result.store.remove(removed)
+        found = [(entrykey, entry)
+                 for (entrykey, entry) in table.changes.iteritems()
+                 if entry is not None]
+        members = self.__members([entry for (entrykey, entry) in found])
+        for ((entrykey, entry), member) in itertools.izip(found, members):
+            if member is None:
+                entries[entrykey] = None
+                continue
+            key = result.store.keys[result.store.add(*member)]
+            entries[entrykey] = key
+            refs[key] = refs.get(key, 0) + 1
+        table.entries = entries
+        table.refs = refs
+        table.result = result
+        table.changes = {}
+
+    def __ldap_timestamp_delta(self, pipeline, table, filterstr):
+        # Deleted entries and entries which no longer match the filter are
+        # only noticed by the next full refresh.
+        if table.timestamp:
+            filterstr = '(&%s(modifyTimestamp>=%s))' % (
+                _filter(filterstr),
+                ldap.filter.escape_filter_chars(table.timestamp))
+        def loaded(result):
+            for (dn, attrs) in result:
+                if dn is None:
+                    continue
+                table.changes[_dnkey(dn)] = (dn, attrs)
+                for timestamp in attrs.get('modifyTimestamp', []):
+                    if table.timestamp is None or timestamp > table.timestamp:
+                        table.timestamp = timestamp
+        pipeline.search(self.ldapbasedn, ldap.SCOPE_SUBTREE, filterstr,
+                        self.__ldap_attrlist() + ['modifyTimestamp'], loaded)
+
+    def __ldap_syncrepl(self, pipeline, table, filterstr):
+        # RFC 4533 refreshOnly synchronization
+        present = {}
+        def purge():
+            # entries not mentioned in a present phase were deleted
+            for uuid in table.entries.keys() + table.changes.keys():
+                if not present.has_key(uuid):
+                    table.changes[uuid] = None
+        def loaded(result):
+            for (dn, attrs, ctrls) in result:
+                for c in ctrls:
+                    if not isinstance(c, SyncStateControl):
+                        continue
+                    if c.state == 'delete':
+                        table.changes[c.entryUUID] = None
                     else:
-                        # or 'Unknown' if neither are defined
-                        try:
-                            tmp_name = mm_cfg.LDAP_DEFAULT_GIVENNAME
-                        except AttributeError:
-                            tmp_name = ''
-                    # build the name
-                    self.__member_names[lce] = tmp_name + sep + surname
-                    try:
-                        if mm_cfg.LDAP_SURNAME_FIRST:
-                            self.__member_names[lce] = surname + sep + tmp_name
-                    except AttributeError:
-                        pass
-                elif attrs.has_key('fullname'):
-                    # since no surname, use full name if defined
-                    fullname = attrs['fullname'][0]
-                    self.__member_names[lce] = fullname
-                elif attrs.has_key('cn'):
-                    # no surname and no full name, use the cn as the name
-                    cn = attrs['cn'][0]
-                    self.__member_names[lce] = cn
-
-    def __ldap_load_members(self):
-        if ( (self.__regularmembers is None)
-            or (self.__digestmembers is None)
-            or (self.__updatetime + self.ldaprefresh < time.time()) ):
-            self.__regularmembers = {}
-            self.__digestmembers = {}
-            self.__updatetime = time.time()
-            l = self.__ldap_bind()
-            self.__ldap_load_members2(l, is_digest=False)
-            if self.ldapdigestsearch:
-                self.__ldap_load_members2(l, is_digest=True)
-
-    def __ldap_load_members2(self, l, is_digest):
-        members = []
+                        present[c.entryUUID] = True
+                        if c.state != 'present':
+                            table.changes[c.entryUUID] = (dn, attrs)
+                    if c.cookie is not None:
+                        table.cookie = c.cookie
+        def intermediate(messages):
+            for (name, value, ctrls) in messages:
+                if name != SyncInfoMessage.responseName:
+                    continue
+                info = SyncInfoMessage(value)
+                if info.newcookie is not None:
+                    table.cookie = info.newcookie
+                elif info.refreshPresent is not None:
+                    purge()
+                    table.cookie = info.refreshPresent.get('cookie',
+                                                           table.cookie)
+                elif info.refreshDelete is not None:
+                    table.cookie = info.refreshDelete.get('cookie',
+                                                          table.cookie)
+                elif info.syncIdSet is not None:
+                    for uuid in info.syncIdSet['syncUUIDs']:
+                        if not info.syncIdSet['refreshDeletes']:
+                            present[uuid] = True
+                        else:
+                            table.changes[uuid] = None
+                    table.cookie = info.syncIdSet.get('cookie', table.cookie)
+        def done(found, ctrls):
+            for c in ctrls:
+                if isinstance(c, SyncDoneControl):
+                    if not c.refreshDeletes:
+                        purge()
+                    if c.cookie is not None:
+                        table.cookie = c.cookie
+        ctrl = SyncRequestControl(cookie=table.cookie, mode='refreshOnly')
+        pipeline.search(self.ldapbasedn, ldap.SCOPE_SUBTREE, filterstr,
+                        self.__ldap_attrlist(), loaded, done, intermediate,
+                        [ctrl])
+
+    #
+    # Membership snapshots shared by all processes through the list directory
+    #
+    def __snapshot_path(self):
+        return os.path.join(self.__mlist.fullpath(), SNAPSHOT_FILE)
+
+    def __snapshot_key(self):
+        # the snapshot is only valid for the settings it was made with
+        filterfunction = self.ldapfilterfunction
+        if filterfunction is not None:
+            filterfunction = getattr(filterfunction, '__name__', None)
+        return hashlib.md5(repr((
+            self.ldapserver, self.ldapbasedn, self.ldapbinddn,
+            self.ldapsearch, self.ldapdigestsearch, self.ldapgroupattr,
+            self.ldapgroupexpansion, self.ldapmailattr, self.ldapnameattr,
+            self.ldappersistentmembers, filterfunction,
+            self.ldaplazynames, self.__rules_key(byname=True)))).hexdigest()
+
+    def __load_snapshot(self):
+        path = self.__snapshot_path()
+        try:
+            mtime = os.stat(path).st_mtime
+            if mtime == self.__snapshot_mtime:
+                # nothing new since we read or wrote it
+                return None
+            fp = open(path, 'rb')
+            try:
+                data = marshal.loads(fp.read())
+            finally:
+                fp.close()
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        self.__snapshot_mtime = mtime
+        if ( (not isinstance(data, tuple)) or (len(data) != 5)
+             or (data[0] != SNAPSHOT_VERSION)
+             or (data[1] != self.__snapshot_key()) ):
+            return None
+        queries = self.__ldap_queries()
+        results = []
+        for (query, updatetime, dump) in zip(queries, data[2], data[3]):
+            result = _QueryResult(updatetime)
+            result.store.load(dump)
+            results.append(result)
+            # the other lists making the search can use it too
+            if query.result is None or query.result.updatetime < updatetime:
+                query.result = result
+        if data[4] is not None:
+            for (query, saved, result) in zip(queries, data[4], results):
+                if saved is None:
+                    continue
+                (fulltime, entries, cookie, timestamp) = saved
+                table = _EntryTable(fulltime)
+                for key in entries.values():
+                    if key is not None:
+                        table.refs[key] = table.refs.get(key, 0) + 1
+                table.entries = entries
+                table.cookie = cookie
+                table.timestamp = timestamp
+                table.result = result
+                if query.table is None or query.table.fulltime < fulltime:
+                    query.table = table
+        return self.__merge(results)
+
+    def __save_snapshot(self, results, queries):
+        # Write to a temporary file and rename it, so that other processes
+        # see either the previous snapshot or the new one, never a torn one.
+        path = self.__snapshot_path()
+        tmppath = '%s.%s.%d' % (path, os.uname()[1], os.getpid())
+        tables = None
+        if [query for query in queries if query.table is not None]:
+            # keep the synchronization state of incremental refreshes, in
+            # the slot of each search, None for those without one
+            tables = []
+            for query in queries:
+                table = query.table
+                if table is None:
+                    tables.append(None)
+                else:
+                    tables.append((table.fulltime, table.entries,
+                                   table.cookie, table.timestamp))
+        # the result of each search, so that they can be refreshed apart
+        data = (SNAPSHOT_VERSION, self.__snapshot_key(),
+                [result.updatetime for result in results],
+                [result.store.dump() for result in results], tables)
         try:
-            result = l.search_s(self.ldapbasedn, ldap.SCOPE_SUBTREE, self.ldapsearch)
-        except ldap.NO_SUCH_OBJECT:
-            result = []
-            syslog('warn',"No entry is found: %s" % self.ldapsearch)
-        for (dn,attrs) in result:
-            if self.ldapgroupattr and attrs.has_key(self.ldapgroupattr):
-                for groupdn in attrs[self.ldapgroupattr]:
-                    try:
-                        members.extend(l.search_s(groupdn, ldap.SCOPE_BASE, '(objectClass=*)'))
-                    except ldap.NO_SUCH_OBJECT:
-                        syslog('warn',"No such object: %s" % groupdn)
+            fp = open(tmppath, 'wb')
+            try:
+                fp.write(marshal.dumps(data, 2))
+            finally:
+                fp.close()
+            os.rename(tmppath, path)
+            self.__snapshot_mtime = os.stat(path).st_mtime
+        except (IOError, OSError) as e:
+            syslog('error', 'Saving members of %s failed: %s'
+                   % (self.__mlist.internal_name(), e))
+            try:
+                os.unlink(tmppath)
+            except OSError:
+                pass
+
+    def __ldap_refresh_background(self):
+        # Refresh in a background thread while the previous snapshot keeps
+        # being served.  Wait for at most ldaprefreshwait seconds.
+        self.__thread_lock.acquire()
+        try:
+            thread = self.__refresh_thread
+            if thread is None or not thread.isAlive():
+                thread = threading.Thread(target=self.__ldap_refresh_quietly)
+                thread.setDaemon(True)
+                thread.start()
+                self.__refresh_thread = thread
+        finally:
+            self.__thread_lock.release()
+        if self.ldaprefreshwait:
+            thread.join(self.ldaprefreshwait)
+
+    def __ldap_refresh_quietly(self):
+        try:
+            self.__ldap_refresh()
+        except Exception as e:
+            syslog('error', 'Refreshing members of %s failed: %s'
+                   % (self.__mlist.internal_name(), e))
+
+    #
+    # Metrics
+    #
+    def __refreshed(self, stats):
+        metrics = self.__metrics
+        stats.duration = time.time() - stats.start
+        metrics.refreshes += 1
+        if stats.error is not None:
+            metrics.failures += 1
+        metrics.last = stats
+        if not self.ldapmetrics:
+            return
+        try:
+            self.__report_metrics(self.__metrics_record())
+        except (IOError, OSError) as e:
+            syslog('error', 'Reporting metrics of %s failed: %s'
+                   % (self.__mlist.internal_name(), e))
+
+    def __metrics_record(self):
+        metrics = self.__metrics
+        stats = metrics.last
+        membership = self.__membership
+        record = {
+            'list': self.__mlist.internal_name(),
+            'pid': os.getpid(),
+            'time': stats.start,
+            'duration': stats.duration,
+            'source': stats.source,
+            'phases': stats.phases,
+            'operations': stats.operations,
+            'entries': stats.entries,
+            'bytes': stats.bytes,
+            'groups': stats.groups,
+            'dncachehits': stats.dncachehits,
+            'error': None,
+            'members': 0,
+            'digestmembers': 0,
+            'addresses': 0,
+            'age': 0,
+            'lookups': metrics.lookups,
+            'stale': metrics.stale,
+            'nonmembers': metrics.nonmembers,
+            'namehits': metrics.namehits,
+            'namemisses': metrics.namemisses,
+            'directhits': metrics.directhits,
+            'directmisses': metrics.directmisses,
+            'refreshes': metrics.refreshes,
+            'failures': metrics.failures,
+            }
+        if stats.error is not None:
+            record['error'] = str(stats.error)
+        if membership is not None:
+            store = membership.store
+            record['members'] = store.count() - len(store.digest)
+            record['digestmembers'] = len(store.digest)
+            record['addresses'] = len(store.index)
+            record['age'] = time.time() - membership.updatetime
+        return record
+
+    def __report_metrics(self, record):
+        if callable(self.ldapmetrics):
+            self.ldapmetrics(record['list'], record)
+        elif self.ldapmetrics == 'syslog':
+            phases = record['phases'].items()
+            phases.sort()
+            syslog('ldap', '%s: refreshed from %s in %.3fs (%s), %d operations,'
+                   ' %d entries, %d bytes, %d groups, %d members, %d digest'
+                   ' members; %d lookups, %d stale, %d of non-members%s'
+                   % (record['list'], record['source'], record['duration'],
+                      ', '.join(['%s %.3fs' % phase for phase in phases]),
+                      record['operations'], record['entries'],
+                      record['bytes'], record['groups'], record['members'],
+                      record['digestmembers'], record['lookups'],
+                      record['stale'], record['nonmembers'],
+                      record['error'] and '; failed: %s' % record['error']
+                      or ''))
+        elif self.ldapmetrics == 'json':
+            self.__write_metrics(
+                os.path.join(self.__mlist.fullpath(), METRICS_FILE),
+                json.dumps(record, sort_keys=True) + '\n')
+        elif self.ldapmetrics == 'prometheus':
+            self.__write_metrics(
+                os.path.join(self.ldapmetricsdir or self.__mlist.fullpath(),
+                             'mailman_ldap_%s.prom' % record['list']),
+                _prometheus(record))
+
+    def __write_metrics(self, path, text):
+        # replace the file at once, as for snapshots
+        tmppath = '%s.%s.%d' % (path, os.uname()[1], os.getpid())
+        fp = open(tmppath, 'w')
+        try:
+            fp.write(text)
+        finally:
+            fp.close()
+        os.rename(tmppath, path)
+
+    #
+    # Journal of membership changes
+    #
+    def __journal_path(self):
+        return os.path.join(self.__mlist.fullpath(), JOURNAL_FILE)
+
+    def __write_journal(self, added, removed):
+        # One line of JSON per refresh, appended with a single write.  It is
+        # stamped with the time of the refresh rather than that of its
+        # oldest search, which stays the same while only some are refreshed.
+        path = self.__journal_path()
+        try:
+            line = json.dumps({'time': time.time(), 'added': added,
+                               'removed': removed}) + '\n'
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = 0
+            if size and size + len(line) > self.ldapjournalsize:
+                os.rename(path, path + '.1')
+            fp = open(path, 'a')
+            try:
+                fp.write(line)
+            finally:
+                fp.close()
+        except (IOError, OSError, ValueError) as e:
+            syslog('error', 'Journaling members of %s failed: %s'
+                   % (self.__mlist.internal_name(), e))
+
+    def __read_journal(self, path, since):
+        try:
+            fp = open(path)
+        except IOError:
+            return []
+        changes = []
+        try:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # torn by a concurrent rotation
+                    continue
+                if since is not None and record['time'] <= since:
+                    continue
+                changes.append((record['time'],
+                                [key.encode('utf-8')
+                                 for key in record['added']],
+                                [key.encode('utf-8')
+                                 for key in record['removed']]))
+        finally:
+            fp.close()
+        return changes
+
+    def __ldap_load_members2(self, pipeline, query):
+        filterstr = query.key[3]
+        expansion = _GroupExpansion(query, _QueryResult(time.time()),
+                                    self.__ldap_attrlist())
+        def loaded(result):
+            self.__loadresult(pipeline, result, expansion)
+        def done(found, ctrls):
+            if not found:
+                syslog('warn',"No entry is found: %s" % filterstr)
+        pipeline.search(self.ldapbasedn, ldap.SCOPE_SUBTREE, filterstr,
+                        expansion.attrlist, loaded, done)
+        def finish():
+            return expansion.result
+        return finish
+
+    def __loadresult(self, pipeline, result, expansion):
+        members = []
+        groups = []
+        for (dn, attrs) in result:
+            if dn is None:
+                # search continuation reference
+                continue
+            values = None
+            if self.ldapgroupattr:
+                values = _group_values(attrs, self.ldapgroupattr)
+            if values is not None:
+                groups.append((dn, values))
+            else:
+                members.append((dn, attrs))
+        self.__loadmembers(expansion.result, members)
+        if groups:
+            self.__ldap_expand_groups(pipeline, groups, expansion)
+
+    def __ldap_expand_groups(self, pipeline, groups, expansion):
+        # Groups found among the members of a group are expanded in turn,
+        # unless they have already been expanded, which also breaks cycles.
+        todo = []
+        for (dn, (memberdns, start)) in groups:
+            key = _dnkey(dn)
+            if expansion.expanded.has_key(key):
+                continue
+            expansion.expanded[key] = True
+            pipeline.stats.groups += 1
+            if self.ldapgroupexpansion == 'memberof':
+                todo.append(dn)
+                continue
+            todo.extend(self.__unresolved(memberdns, expansion))
+            if start is not None:
+                self.__ldap_search_range(pipeline, dn, start, expansion)
+        if self.ldapgroupexpansion == 'memberof':
+            for i in range(0, len(todo), self.ldapgroupchunksize):
+                self.__ldap_search_memberof(
+                    pipeline, todo[i:i + self.ldapgroupchunksize], expansion)
+        else:
+            self.__ldap_resolve_dns(pipeline, todo, expansion)
+
+    def __unresolved(self, memberdns, expansion):
+        # the member DNs not resolved yet, which are about to be
+        todo = []
+        for memberdn in memberdns:
+            mkey = _dnkey(memberdn)
+            if not expansion.resolved.has_key(mkey):
+                expansion.resolved[mkey] = True
+                todo.append(memberdn)
+        return todo
+
+    def __ldap_search_range(self, pipeline, groupdn, start, expansion):
+        # Active Directory returns at most MaxValRange values of an
+        # attribute at once.  The following ranges of values are searched
+        # one after the other, and their DNs resolved as they arrive.
+        def loaded(result):
+            for (dn, attrs) in result:
+                if dn is None:
+                    continue
+                values = _group_values(attrs, self.ldapgroupattr)
+                if values is None:
+                    continue
+                memberdns, start = values
+                self.__ldap_resolve_dns(
+                    pipeline, self.__unresolved(memberdns, expansion),
+                    expansion)
+                if start is not None:
+                    self.__ldap_search_range(pipeline, groupdn, start,
+                                             expansion)
+        pipeline.search(groupdn, ldap.SCOPE_BASE, '(objectClass=*)',
+                        ['%s;range=%d-*' % (self.ldapgroupattr, start)],
+                        loaded)
+
+    def __ldap_resolve_dns(self, pipeline, dns, expansion):
+        cached = []
+        missing = []
+        now = time.time()
+        dn_cache = expansion.query.dn_cache
+        if self.ldapgroupcache:
+            for key in [key for (key, (expire, entry))
+                        in dn_cache.items() if expire <= now]:
+                del dn_cache[key]
+        for dn in dns:
+            if dn_cache.has_key(_dnkey(dn)):
+                entry = dn_cache[_dnkey(dn)][1]
+                if entry is not None:
+                    cached.append(entry)
             else:
+                missing.append(dn)
+        if cached:
+            pipeline.stats.dncachehits += len(cached)
+            self.__loadresult(pipeline, cached, expansion)
+        if self.ldapgroupexpansion == 'filter':
+            chunksize = self.ldapgroupchunksize
+        else:
+            chunksize = 1
+        for i in range(0, len(missing), chunksize):
+            self.__ldap_resolve_chunk(pipeline, missing[i:i + chunksize],
+                                      expansion)
+
+    def __ldap_resolve_chunk(self, pipeline, dns, expansion):
+        pending = dict([(_dnkey(dn), dn) for dn in dns])
+        def loaded(result):
+            for entry in result:
+                if entry[0] is not None:
+                    key = _dnkey(entry[0])
+                    if pending.has_key(key):
+                        del pending[key]
+                    self.__cache_dn(expansion.query, key, entry)
+            self.__loadresult(pipeline, result, expansion)
+        filtered = self.__filter_rules()[0] is not None
+        def done(found, ctrls):
+            for (key, dn) in pending.items():
+                # entries may also be missing because the rules drop them
+                if not found or not filtered:
+                    syslog('warn',"No such object: %s" % dn)
+                self.__cache_dn(expansion.query, key, None)
+        if self.ldapgroupexpansion == 'filter':
+            filterstr = '(|%s)' % ''.join(
+                ['(%s=%s)' % (self.ldapgroupdnattr,
+                              ldap.filter.escape_filter_chars(dn))
+                 for dn in dns])
+            # at most one entry per DN, so not paged if less than a page
+            pipeline.search(self.ldapbasedn, ldap.SCOPE_SUBTREE,
+                            self.__ldap_filter(filterstr),
+                            expansion.attrlist, loaded, done,
+                            paged=len(dns) >= self.ldappagesize)
+        else:
+            pipeline.search(dns[0], ldap.SCOPE_BASE,
+                            self.__ldap_filter('(objectClass=*)'),
+                            expansion.attrlist, loaded, done)
+
+    def __cache_dn(self, query, key, entry):
+        if self.ldapgroupcache:
+            query.dn_cache[key] = (time.time() + self.ldapgroupcache, entry)
+
+    def __ldap_search_memberof(self, pipeline, groupdns, expansion):
+        def loaded(result):
+            members = []
+            for (dn, attrs) in result:
+                if dn is None or expansion.resolved.has_key(_dnkey(dn)):
+                    continue
+                expansion.resolved[_dnkey(dn)] = True
                 members.append((dn, attrs))
-        self.__loadmembers(members, is_digest=is_digest)
+            self.__loadresult(pipeline, members, expansion)
+        filterstr = '(|%s)' % ''.join(
+            ['(%s=%s)' % (self.ldapmemberofattr,
+                          ldap.filter.escape_filter_chars(dn))
+             for dn in groupdns])
+        pipeline.search(self.ldapbasedn, ldap.SCOPE_SUBTREE,
+                        self.__ldap_filter(filterstr), expansion.attrlist,
+                        loaded)
 
     def __ldap_get_regular_members(self):
-        self.__ldap_load_members()
-        return self.__regularmembers.keys()
+        return self.__ldap_load_members().store.regular_keys()
     
     def __ldap_get_digest_members(self):
-        self.__ldap_load_members()
-        return self.__digestmembers.keys()
+        return self.__ldap_load_members(digest=True).store.digest_keys()
 
     def __ldap_get_members(self):
-        return self.__ldap_get_regular_members() + self.__ldap_get_digest_members()
-    
-
-
-    def __ldap_get_member_cpe(self, member):
-        self.__ldap_load_members()
-        return self.__member_map[member.lower()]
+        return self.__ldap_load_members().store.keys[:]
+
+    def __ldap_lookup(self, members):
+        # The store of the members and the position in it of each of
+        # members, None for non-members, all from the same snapshot.
+        store = self.__ldap_load_members().store
+        index = store.index
+        positions = [index.get(member.lower()) for member in members]
+        self.__metrics.nonmembers += positions.count(None)
+        return store, positions
+
+    def __ldap_get_member_cpes(self, members):
+        store, positions = self.__ldap_lookup(members)
+        addresses = store.addresses
+        cpes = []
+        for pos in positions:
+            if pos is None:
+                cpes.append(None)
+            else:
+                cpes.append(addresses[pos])
+        return cpes
 
     def __ldap_is_member(self, member):
-        self.__ldap_load_members()
-        return self.__member_map.has_key(member.lower())
+        if self.ldapdirectlookup and not self.ldapgroupattr:
+            found = self.__ldap_direct_lookup(member.lower())
+        else:
+            found = self.__ldap_load_members().store.index.has_key(
+                member.lower())
+        if found:
+            return True
+        self.__metrics.nonmembers += 1
+        return False
+
+    def __ldap_direct_lookup(self, key):
+        # Whether key is a member, from the members if they are fresh, or
+        # from the cache or a search of that address alone otherwise, so
+        # that all the members are never loaded for it.
+        metrics = self.__metrics
+        metrics.lookups += 1
+        membership = self.__membership
+        if ( (membership is not None)
+             and (not self.__expired(membership, False, time.time())) ):
+            return membership.store.index.has_key(key)
+        for address in self.ldappersistentmembers:
+            if address.lower() == key:
+                return True
+        cache = self.__lookup_cache
+        if ( (cache is None) or (cache.size != self.ldaplookupcache)
+             or (cache.ttl != self.ldaplookupttl) ):
+            cache = self.__lookup_cache = _LRUCache(self.ldaplookupcache,
+                                                    self.ldaplookupttl)
+        cached, found = cache.get(key)
+        if cached:
+            metrics.directhits += 1
+            return found
+        metrics.directmisses += 1
+        result = _QueryResult(time.time())
+        try:
+            self.__ldap_failover(
+                lambda l, server: self.__ldap_search_address(l, server, key,
+                                                             result))
+        except ldap.LDAPError as e:
+            if membership is None:
+                raise
+            syslog('error', 'Looking %s up in %s failed, using the previous'
+                   ' members: %s' % (key, self.__mlist.internal_name(), e))
+            metrics.stale += 1
+            return membership.store.index.has_key(key)
+        found = result.store.index.has_key(key)
+        if found:
+            cache.put(key, True)
+        else:
+            cache.put(key, False, self.ldapnonmemberttl)
+        return found
+
+    def __ldap_search_address(self, l, server, key, result):
+        # the entries of the members with the address key, loaded into
+        # result as a refresh would
+        pipeline = _SearchPipeline(l, 1, 0, self.ldaptimeout, server=server)
+        value = ldap.filter.escape_filter_chars(key)
+        filterstr = _filter(self.ldapsearch)
+        if self.ldapdigestsearch:
+            filterstr = '(|%s%s)' % (filterstr,
+                                     _filter(self.ldapdigestsearch))
+        filterstr = '(&%s(|(%s=%s)(mailalternateaddress=%s)))' % (
+            filterstr, self.ldapmailattr, value, value)
+        def loaded(entries):
+            # skip search continuation references
+            self.__loadmembers(result, [entry for entry in entries
+                                        if entry[0] is not None])
+        pipeline.search(self.ldapbasedn, ldap.SCOPE_SUBTREE,
+                        self.__ldap_filter(filterstr),
+                        self.__ldap_attrlist(), loaded)
+        pipeline.run()
+
+    def __ldap_member_names(self, store, positions):
+        # the names of the members at these positions of store
+        names = store.names
+        if self.ldaplazynames:
+            # one batch for all the names not cached
+            keys = store.keys
+            found = self.__ldap_names([keys[pos] for pos in positions
+                                       if pos is not None])
+            names = {}
+            for pos in positions:
+                if pos is not None:
+                    names[pos] = found[keys[pos]]
+        cns = []
+        for pos in positions:
+            if pos is None:
+                cns.append(None)
+            else:
+                cns.append(names[pos])
+        return cns
+
+    #
+    # Names searched when needed, with ldaplazynames
+    #
+    def __ldap_names(self, keys):
+        # the names of the members with these keys, from the cache or
+        # searched in batches
+        cache = self.__name_cache
+        if ( (cache is None) or (cache.size != self.ldapnamecache)
+             or (cache.ttl != self.ldapnamettl) ):
+            cache = self.__name_cache = _LRUCache(self.ldapnamecache,
+                                                  self.ldapnamettl)
+        names = {}
+        missing = []
+        for key in keys:
+            cached, name = cache.get(key)
+            if cached:
+                names[key] = name
+            else:
+                missing.append(key)
+        self.__metrics.namehits += len(keys) - len(missing)
+        self.__metrics.namemisses += len(missing)
+        if missing:
+            found = {}
+            try:
+                self.__ldap_failover(
+                    lambda l, server: self.__ldap_search_names(
+                        l, server, missing, found))
+            except ldap.LDAPError as e:
+                # names are not worth failing for, nor caching their absence
+                syslog('error', 'Searching names of members of %s failed: %s'
+                       % (self.__mlist.internal_name(), e))
+                for key in missing:
+                    names[key] = None
+                return names
+            for key in missing:
+                names[key] = found.get(key)
+                cache.put(key, names[key])
+        return names
+
+    def __ldap_search_names(self, l, server, keys, found):
+        pipeline = _SearchPipeline(l, self.ldapconcurrency, self.ldappagesize,
+                                   self.ldaptimeout, server=server)
+        attrlist = [self.ldapmailattr] + self.__ldap_name_attrlist()
+        wanted = dict([(key, True) for key in keys])
+        def loaded(result):
+            for (dn, attrs) in result:
+                if dn is None or not attrs.has_key(self.ldapmailattr):
+                    continue
+                key = attrs[self.ldapmailattr][0].strip().lower()
+                if wanted.has_key(key):
+                    found[key] = self.__member_name(attrs)
+        for i in range(0, len(keys), NAME_BATCH):
+            filterstr = '(|%s)' % ''.join(
+                ['(%s=%s)' % (self.ldapmailattr,
+                              ldap.filter.escape_filter_chars(key))
+                 for key in keys[i:i + NAME_BATCH]])
+            pipeline.search(self.ldapbasedn, ldap.SCOPE_SUBTREE, filterstr,
+                            attrlist, loaded)
+        pipeline.run()
 
-    def __ldap_mail_to_cn(self, member):
-        self.__ldap_load_members()
-        return self.__member_names.get(member.lower(), None)
-
     #
     # The readable interface
     #
@@ -303,6 +2465,36 @@ class LDAPMemberships(MemberAdaptor.MemberAdaptor):
         LDAP-based lists do not implement digest delivery yet."""
         return self.__ldap_get_digest_members()
 
+    def refreshMembers(self):
+        """Refresh the members from the directory now, whatever their age.
+
+        Return the sorted KEY/LCEs of the members who joined and of those
+        who left since the members known before, in this process or in the
+        snapshot file.  If none were known, all the members joined.  The
+        LDAPError of a failed refresh is raised.
+        """
+        stats = _RefreshStats()
+        stats.delta = True
+        self.__ldap_refresh(force=True, stats=stats)
+        if stats.error is not None:
+            raise stats.error
+        added, removed = stats.added, stats.removed
+        stats.added = stats.removed = None
+        return added, removed
+
+    def getMemberChanges(self, since=None):
+        """Return the changes of the members journaled with ldapjournal.
+
+        Each change is a tuple of the time of a refresh, and of the sorted
+        KEY/LCEs of the members who joined and of those who left since the
+        previous refresh, oldest first.  If since is given, only the changes
+        of later refreshes are returned.  Changes older than the rotated
+        journal are lost.
+        """
+        path = self.__journal_path()
+        return (self.__read_journal(path + '.1', since)
+                + self.__read_journal(path, since))
+
     def isMember(self, member):
         """Return 1 if member KEY/LCE is a valid member, otherwise 0."""
         retval = self.__ldap_is_member(member)
@@ -320,6 +2512,16 @@ class LDAPMemberships(MemberAdaptor.MemberAdaptor):
         if not self.isMember(member): raise NotAMemberError
         return member
 
+    def areMembers(self, members):
+        """Return a sequence of booleans for the given sequence of members.
+
+        Each is true if the KEY/LCE at the same position of members is a valid
+        member, as isMember() would return, but all the members are looked up
+        at once.
+        """
+        store, positions = self.__ldap_lookup(members)
+        return [pos is not None for pos in positions]
+
     def getMemberCPAddress(self, member):
         """Return the CPE for the member KEY/LCE.
 
@@ -327,8 +2529,9 @@ class LDAPMemberships(MemberAdaptor.MemberAdaptor):
 
         LDAP-based lists use the 'mail' field as both CPE and KEY.
         """
-        if not self.isMember(member): raise NotAMemberError
-        return self.__ldap_get_member_cpe(member)
+        cpe = self.__ldap_get_member_cpes([member])[0]
+        if cpe is None: raise NotAMemberError
+        return cpe
 
     def getMemberCPAddresses(self, members):
         """Return a sequence of CPEs for the given sequence of members.
@@ -338,7 +2541,7 @@ class LDAPMemberships(MemberAdaptor.MemberAdaptor):
         in the returned sequence will be None (i.e. NotAMemberError is never
         raised).
         """
-        return [self.getMemberCPAddress(member) for member in members]
+        return self.__ldap_get_member_cpes(members)
 
     def authenticateMember(self, member, response):
         """Authenticate the member KEY/LCE with the given response.
@@ -400,11 +2603,20 @@ class LDAPMemberships(MemberAdaptor.MemberAdaptor):
         characters in the name.  NotAMemberError is raised if member does not
         refer to a valid member.
         """
-        if not self.isMember(member): raise NotAMemberError
-        try:
-            return self.__ldap_mail_to_cn(member)
-        except ldap.LDAPError:
-            raise NotAMemberError
+        store, positions = self.__ldap_lookup([member])
+        if positions[0] is None: raise NotAMemberError
+        return self.__ldap_member_names(store, positions)[0]
+
+    def getMemberNames(self, members):
+        """Return a sequence of full names for the given sequence of members.
+
+        The returned sequence will be the same length as members.  An entry is
+        None if the member has no registered full name, or if the KEY/LCE at
+        the same position of members does not refer to a valid member (i.e.
+        NotAMemberError is never raised).
+        """
+        store, positions = self.__ldap_lookup(members)
+        return self.__ldap_member_names(store, positions)
 
     def getMemberTopics(self, member):
         """Return the list of topics this member is interested in.
@@ -457,9 +2669,13 @@ class LDAPMemberships(MemberAdaptor.MemberAdaptor):
         Optional `status' if given, must be a sequence containing one or more
         of ENABLED, UNKNOWN, BYUSER, BYADMIN, or BYBOUNCE.  The members whose
         delivery status is in this sequence are returned.
+
+        All the members of LDAP-based lists are ENABLED, so that no member
+        needs to be looked at.
         """
-        return [member for member in self.getMembers()
-                if self.getDeliveryStatus(member) in status]
+        if MemberAdaptor.ENABLED in status:
+            return self.getMembers()
+        return []
 
     def getBouncingMembers(self):
         """Return the list of members who have outstanding bounce information.
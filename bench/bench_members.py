@@ -0,0 +1,409 @@
+#! /usr/bin/env python
+#
+# bench_members.py -- benchmarks of LDAPMemberships against a fake directory
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+
+"""Benchmark LDAPMemberships against a synthetic directory.
+
+Usage: bench_members.py [options]
+
+Each scenario runs in a fresh process, against the in-process fake LDAP
+server of fakeldap.py.  For each scenario, the time of the first (cold)
+refresh, the peak resident memory of the process, the number of LDAP
+operations and entries received, and the throughput of isMember() and
+getMemberCPAddresses() are reported.
+
+Results are appended to a history file, one JSON record per run, and
+compared with the previous run of the same scenario, so that regressions
+of the hot paths stand out.
+
+Options:
+
+    -s SIZES, --sizes=SIZES
+        Comma-separated numbers of people in the directory
+        (default: 1000,10000,100000).
+
+    -g N, --groups=N
+        Number of groups in the group scenarios (default: 10).
+
+    -G N, --groupsize=N
+        Number of people in each group (default: 1000).
+
+    -l SECONDS, --latency=SECONDS
+        Latency of each LDAP operation (default: 0.001).
+
+    -p BYTES, --photosize=BYTES
+        Size of a jpegPhoto attribute given to every person (default: 0).
+
+    -r N, --maxvalrange=N
+        Return at most N values of an attribute at once, as Active Directory
+        does (default: 0, no limit).
+
+    -k NAMES, --scenarios=NAMES
+        Comma-separated scenarios to run (default: all of them).
+
+    -H FILE, --history=FILE
+        History file (default: bench/history.jsonl next to this script).
+
+    -t PERCENT, --threshold=PERCENT
+        Changes worse than this are reported as regressions (default: 20).
+
+    -h, --help
+        Print this message and exit.
+"""
+
+import gc
+import os
+import sys
+import time
+import getopt
+import subprocess
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOP = os.path.dirname(HERE)
+
+# name -> (LDAPMemberships settings, uses groups)
+SCENARIOS = {
+    'search':         ({'ldapsearch': '(objectClass=inetOrgPerson)'}, False),
+    'search-nopage':  ({'ldapsearch': '(objectClass=inetOrgPerson)',
+                        'ldappagesize': 0}, False),
+    'search-lazynames': ({'ldapsearch': '(objectClass=inetOrgPerson)',
+                          'ldaplazynames': True}, False),
+    'search-rules':   ({'ldapsearch': '(objectClass=inetOrgPerson)',
+                        'ldapfilterrules': [('exclude', 'uid', '=', 'user1*'),
+                                            ('exclude', 'uid', '~', '7$')]},
+                       False),
+    'groups-base':    ({'ldapsearch': '(objectClass=groupOfNames)',
+                        'ldapgroupattr': 'member',
+                        'ldapgroupexpansion': 'base'}, True),
+    'groups-filter':  ({'ldapsearch': '(objectClass=groupOfNames)',
+                        'ldapgroupattr': 'member',
+                        'ldapgroupexpansion': 'filter'}, True),
+    'groups-memberof': ({'ldapsearch': '(objectClass=groupOfNames)',
+                         'ldapgroupattr': 'member',
+                         'ldapgroupexpansion': 'memberof'}, True),
+    }
+
+# throughput measurements run for about this many seconds
+MEASURE_TIME = 1.0
+
+def usage(code, msg=''):
+    if code:
+        fd = sys.stderr
+    else:
+        fd = sys.stdout
+    fd.write(__doc__)
+    if msg:
+        fd.write('\n%s\n' % msg)
+    sys.exit(code)
+
+#
+# Stand-ins for Mailman, so that LDAPMemberships can be loaded outside of it
+#
+def install_mailman():
+    import types
+    modules = {}
+    for name in ('Mailman', 'Mailman.Logging', 'Mailman.Logging.Syslog',
+                 'Mailman.MemberAdaptor', 'Mailman.mm_cfg', 'Mailman.Errors'):
+        modules[name] = types.ModuleType(name)
+    modules['Mailman'].__path__ = []
+    modules['Mailman.Logging'].__path__ = []
+    modules['Mailman.Logging.Syslog'].syslog = lambda kind, msg, *args: None
+    adaptor = modules['Mailman.MemberAdaptor']
+    class MemberAdaptor:
+        pass
+    adaptor.MemberAdaptor = MemberAdaptor
+    (adaptor.ENABLED, adaptor.UNKNOWN, adaptor.BYUSER, adaptor.BYADMIN,
+     adaptor.BYBOUNCE) = range(5)
+    modules['Mailman.mm_cfg'].Moderate = 128
+    modules['Mailman.mm_cfg'].DEFAULT_NEW_MEMBER_OPTIONS = 256
+    class NotAMemberError(Exception):
+        pass
+    modules['Mailman.Errors'].NotAMemberError = NotAMemberError
+    modules['Mailman.Errors'].__all__ = ['NotAMemberError']
+    modules['Mailman'].Logging = modules['Mailman.Logging']
+    modules['Mailman'].MemberAdaptor = adaptor
+    modules['Mailman.Logging'].Syslog = modules['Mailman.Logging.Syslog']
+    sys.modules.update(modules)
+    import imp
+    return imp.load_source('Mailman.LDAPMemberships',
+                           os.path.join(TOP, 'LDAPMemberships.py'))
+
+class FakeList:
+    """The little of a MailList which LDAPMemberships uses."""
+
+    preferred_language = 'en'
+    default_member_moderation = 0
+    topics = []
+
+    def __init__(self, name, path):
+        self.__name = name
+        self.__path = path
+
+    def internal_name(self):
+        return self.__name
+
+    def fullpath(self):
+        return self.__path
+
+def peak_rss():
+    # peak resident set size of this process, in kilobytes
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss = rss / 1024
+    return rss
+
+def current_rss():
+    # resident set size of this process, in kilobytes, where it is known
+    try:
+        fp = open('/proc/self/statm')
+    except IOError:
+        return None
+    try:
+        pages = int(fp.read().split()[1])
+    finally:
+        fp.close()
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1024
+
+def throughput(func, items):
+    # calls of func per second, over items repeated for MEASURE_TIME
+    count = 0
+    start = time.time()
+    while True:
+        func(items)
+        count += len(items)
+        elapsed = time.time() - start
+        if elapsed >= MEASURE_TIME:
+            return count / elapsed
+
+def run_scenario(name, size, groups, groupsize, latency, photosize,
+                 maxvalrange):
+    sys.path.insert(0, HERE)
+    import fakeldap
+    directory = fakeldap.Directory('dc=example,dc=net',
+                                   maxvalrange=maxvalrange)
+    settings, with_groups = SCENARIOS[name]
+    if not with_groups:
+        groups = 0
+    directory.generate(entries=size, photosize=photosize, groups=groups,
+                       groupsize=groupsize, nested=groups and 1)
+    fakeldap.install(directory, latency)
+    module = install_mailman()
+    gc.collect()
+    rss_before = peak_rss()
+    current_before = current_rss()
+    adaptor = module.LDAPMemberships(FakeList(name, '/nonexistent'))
+    adaptor.ldapserver = 'ldap://fake'
+    adaptor.ldapbasedn = directory.basedn
+    adaptor.ldapbinddn = ''
+    adaptor.ldappasswd = ''
+    for (key, value) in settings.items():
+        setattr(adaptor, key, value)
+    start = time.time()
+    members = adaptor.getMembers()
+    refresh = time.time() - start
+    rss_after = peak_rss()
+    # what the members keep once the entries received are gone
+    gc.collect()
+    retained = current_rss()
+    if retained is not None:
+        retained -= current_before
+    # half of the lookups are for non-members
+    probes = members[:1000] + ['nobody%d@example.org' % i
+                               for i in range(min(len(members), 1000))]
+    def is_member(addresses):
+        for address in addresses:
+            adaptor.isMember(address)
+    return {
+        'scenario': name,
+        'size': size,
+        'groups': groups,
+        'groupsize': groups and groupsize,
+        'latency': latency,
+        'photosize': photosize,
+        'maxvalrange': maxvalrange,
+        'members': len(members),
+        'refresh': refresh,
+        'peak_rss_kb': rss_after,
+        'refresh_rss_kb': rss_after - rss_before,
+        'retained_kb': retained,
+        'operations': directory.stats['operations'],
+        'entries': directory.stats['entries'],
+        'values': directory.stats['values'],
+        'ismember_per_s': throughput(is_member, probes),
+        'cpaddresses_per_s': throughput(adaptor.getMemberCPAddresses,
+                                        members[:10000]),
+        }
+
+#
+# History
+#
+# lower is better for these, higher is better for the others compared
+LOWER_IS_BETTER = ('refresh', 'peak_rss_kb', 'refresh_rss_kb', 'retained_kb',
+                   'operations', 'entries', 'values')
+COMPARED = LOWER_IS_BETTER + ('ismember_per_s', 'cpaddresses_per_s')
+
+def revision():
+    try:
+        proc = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'],
+                                cwd=TOP, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        return proc.communicate()[0].strip() or None
+    except OSError:
+        return None
+
+def same_scenario(x, y):
+    for key in ('scenario', 'size', 'groups', 'groupsize', 'latency',
+                'photosize', 'maxvalrange'):
+        if x.get(key) != y.get(key):
+            return False
+    return True
+
+def load_history(path):
+    records = []
+    try:
+        fp = open(path)
+    except IOError:
+        return records
+    try:
+        for line in fp:
+            if line.strip():
+                records.append(json.loads(line))
+    finally:
+        fp.close()
+    return records
+
+def compare(result, history, threshold):
+    previous = None
+    for record in history:
+        if same_scenario(record, result):
+            previous = record
+    if previous is None:
+        return []
+    notes = []
+    for key in COMPARED:
+        old = previous.get(key)
+        new = result.get(key)
+        if not old or new is None:
+            continue
+        change = 100.0 * (new - old) / old
+        if key not in LOWER_IS_BETTER:
+            change = -change
+        if change > threshold:
+            notes.append('REGRESSION %s %+.0f%% (%s -> %s, %s)'
+                         % (key, change, fmt(old), fmt(new),
+                            previous.get('revision')))
+    return notes
+
+def fmt(value):
+    if isinstance(value, float):
+        return '%.4g' % value
+    return str(value)
+
+def report(result):
+    print('%-16s %7d people %6d members  refresh %8.3fs  rss +%7d kB  '
+          'kept %7s kB  %6d ops %8d entries  isMember %9.0f/s  '
+          'CPAddresses %9.0f/s'
+          % (result['scenario'], result['size'], result['members'],
+             result['refresh'], result['refresh_rss_kb'],
+             result.get('retained_kb'),
+             result['operations'], result['entries'],
+             result['ismember_per_s'], result['cpaddresses_per_s']))
+
+def main():
+    try:
+        opts, args = getopt.getopt(
+            sys.argv[1:], 's:g:G:l:p:r:k:H:t:h',
+            ['sizes=', 'groups=', 'groupsize=', 'latency=', 'photosize=',
+             'maxvalrange=', 'scenarios=', 'history=', 'threshold=', 'help',
+             'run='])
+    except getopt.error, msg:
+        usage(1, msg)
+    sizes = [1000, 10000, 100000]
+    groups = 10
+    groupsize = 1000
+    latency = 0.001
+    photosize = 0
+    maxvalrange = 0
+    scenarios = sorted(SCENARIOS.keys())
+    history = os.path.join(HERE, 'history.jsonl')
+    threshold = 20.0
+    child = None
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            usage(0)
+        elif opt in ('-s', '--sizes'):
+            sizes = [int(size) for size in arg.split(',')]
+        elif opt in ('-g', '--groups'):
+            groups = int(arg)
+        elif opt in ('-G', '--groupsize'):
+            groupsize = int(arg)
+        elif opt in ('-l', '--latency'):
+            latency = float(arg)
+        elif opt in ('-p', '--photosize'):
+            photosize = int(arg)
+        elif opt in ('-r', '--maxvalrange'):
+            maxvalrange = int(arg)
+        elif opt in ('-k', '--scenarios'):
+            scenarios = arg.split(',')
+            for name in scenarios:
+                if not SCENARIOS.has_key(name):
+                    usage(1, 'Unknown scenario: %s' % name)
+        elif opt in ('-H', '--history'):
+            history = arg
+        elif opt in ('-t', '--threshold'):
+            threshold = float(arg)
+        elif opt == '--run':
+            child = arg
+    if child:
+        # run one scenario in this process and print the result
+        name, size = child.split(':')
+        result = run_scenario(name, int(size), groups, groupsize, latency,
+                              photosize, maxvalrange)
+        print(json.dumps(result))
+        return
+    past = load_history(history)
+    rev = revision()
+    regressions = 0
+    fp = open(history, 'a')
+    try:
+        for size in sizes:
+            for name in scenarios:
+                proc = subprocess.Popen(
+                    [sys.executable, os.path.abspath(__file__),
+                     '--run=%s:%d' % (name, size), '-g', str(groups),
+                     '-G', str(groupsize), '-l', str(latency),
+                     '-p', str(photosize), '-r', str(maxvalrange)],
+                    stdout=subprocess.PIPE)
+                output = proc.communicate()[0]
+                if proc.returncode:
+                    print('%-16s %7d people FAILED' % (name, size))
+                    regressions += 1
+                    continue
+                result = json.loads(output.strip().splitlines()[-1])
+                result['revision'] = rev
+                result['time'] = time.time()
+                report(result)
+                for note in compare(result, past, threshold):
+                    print('    ' + note)
+                    regressions += 1
+                fp.write(json.dumps(result, sort_keys=True) + '\n')
+                fp.flush()
+    finally:
+        fp.close()
+    if regressions:
+        sys.exit(2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,498 @@
+#
+# fakeldap -- an in-process stand-in for python-ldap, for benchmarks
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+
+"""An in-process stand-in for the parts of python-ldap which are used by
+LDAPMemberships, serving a synthetic directory.
+
+    directory = fakeldap.Directory('dc=example,dc=net')
+    directory.generate(entries=10000, groups=10, groupsize=500)
+    fakeldap.install(directory, latency=0.002)
+
+After install(), "import ldap" returns the stand-in.  Every operation
+sent to the fake server is answered `latency' seconds after it was
+submitted, so concurrently outstanding operations overlap as they would
+over a network.  The number of operations, entries and attribute values
+sent is counted in directory.stats.
+"""
+
+import re
+import sys
+import time
+import types
+import random
+
+SCOPE_BASE = 0
+SCOPE_ONELEVEL = 1
+SCOPE_SUBTREE = 2
+
+RES_ANY = -1
+RES_SEARCH_ENTRY = 0x64
+RES_SEARCH_RESULT = 0x65
+RES_SEARCH_REFERENCE = 0x73
+RES_INTERMEDIATE = 0x79
+
+OPT_TIMEOUT = 0x5002
+OPT_NETWORK_TIMEOUT = 0x5005
+OPT_REFERRALS = 0x0008
+
+# errors report the message id of the failed operation, as in python-ldap 3
+__version__ = '3.4.0'
+
+class LDAPError(Exception): pass
+class SERVER_DOWN(LDAPError): pass
+class CONNECT_ERROR(LDAPError): pass
+class TIMEOUT(LDAPError): pass
+class NO_SUCH_OBJECT(LDAPError): pass
+class PROTOCOL_ERROR(LDAPError): pass
+class FILTER_ERROR(LDAPError): pass
+class DECODING_ERROR(LDAPError): pass
+class SIZELIMIT_EXCEEDED(LDAPError): pass
+class UNAVAILABLE_CRITICAL_EXTENSION(LDAPError): pass
+
+#
+# The directory
+#
+class Directory:
+    """A synthetic directory of people and groups."""
+
+    def __init__(self, basedn='dc=example,dc=net', sizelimit=0,
+                 maxvalrange=0):
+        self.basedn = basedn
+        self.sizelimit = sizelimit
+        # like Active Directory, return at most maxvalrange values of an
+        # attribute at once, as "attr;range=low-high"
+        self.maxvalrange = maxvalrange
+        self.entries = {}
+        self.stats = {'operations': 0, 'entries': 0, 'values': 0}
+        self.__indexes = {}
+
+    def add(self, dn, attrs):
+        self.entries[dn.lower()] = (dn, attrs)
+        self.__indexes = {}
+
+    def delete(self, dn):
+        del self.entries[dn.lower()]
+        self.__indexes = {}
+
+    def generate(self, entries=1000, multimail=0.1, alternates=0.2,
+                 photosize=0, groups=0, groupsize=0, nested=0, seed=1):
+        """Generate `entries' people, of which a fraction `multimail' have
+        two mail values and a fraction `alternates' an alternate address,
+        and `groups' groups of `groupsize' random people each.  The first
+        `nested' groups also contain the next group."""
+        rand = random.Random(seed)
+        people = []
+        for i in range(entries):
+            dn = 'uid=user%d,ou=people,%s' % (i, self.basedn)
+            attrs = {
+                'objectClass': ['top', 'person', 'inetOrgPerson'],
+                'uid': ['user%d' % i],
+                'mail': ['User%d@Example.NET' % i],
+                'cn': ['Given%d Sur%d' % (i, i)],
+                'sn': ['Sur%d' % i],
+                'givenname': ['Given%d' % i],
+                'modifyTimestamp': ['20260101000000Z'],
+                'entryUUID': ['%08x-0000-0000-0000-000000000000' % i],
+                }
+            if rand.random() < multimail:
+                attrs['mail'].append('user%d@mail.example.net' % i)
+            if rand.random() < alternates:
+                attrs['mailalternateaddress'] = ['u%d@alt.example.net' % i]
+            if photosize:
+                attrs['jpegPhoto'] = ['\0' * photosize]
+            self.add(dn, attrs)
+            people.append(dn)
+        for g in range(groups):
+            dn = 'cn=group%d,ou=groups,%s' % (g, self.basedn)
+            members = rand.sample(people, min(groupsize, len(people)))
+            if g < nested and g + 1 < groups:
+                members.append('cn=group%d,ou=groups,%s' % (g + 1, self.basedn))
+            self.add(dn, {'objectClass': ['top', 'groupOfNames'],
+                          'cn': ['group%d' % g],
+                          'member': members,
+                          'entryUUID': ['%08x-0000-0000-0000-00000000000g' % g]})
+        # memberOf, as maintained by the memberof overlay
+        for (dn, attrs) in self.entries.values():
+            for memberdn in attrs.get('member', []):
+                entry = self.entries.get(memberdn.lower())
+                if entry is not None:
+                    entry[1].setdefault('memberOf', []).append(dn)
+        self.__indexes = {}
+
+    def search(self, base, scope, filterstr, attrlist, select=True):
+        node = _parse_filter(filterstr)
+        base = base.lower()
+        if scope == SCOPE_BASE:
+            if not self.entries.has_key(base):
+                raise NO_SUCH_OBJECT({'desc': 'No such object'})
+            candidates = [self.entries[base]]
+        else:
+            suffix = ',' + base
+            keys = self.__candidates(node)
+            if keys is None:
+                keys = self.entries.keys()
+            candidates = [self.entries[key] for key in keys
+                          if key == base or key.endswith(suffix)]
+            candidates.sort()
+        result = [(dn, attrs) for (dn, attrs) in candidates
+                  if _match(node, dn, attrs)]
+        if select:
+            result = [(dn, _select(attrs, attrlist, self.maxvalrange))
+                      for (dn, attrs) in result]
+        return result
+
+    def __candidates(self, node):
+        # Keys of the entries which may match, using equality indexes, or
+        # None if every entry has to be tried.
+        kind = node[0]
+        if kind == '|':
+            keys = {}
+            for child in node[1]:
+                found = self.__candidates(child)
+                if found is None:
+                    return None
+                for key in found:
+                    keys[key] = True
+            return keys.keys()
+        if kind == '&':
+            for child in node[1]:
+                found = self.__candidates(child)
+                if found is not None:
+                    return found
+            return None
+        if kind != 'cmp' or node[2] != '=' or '*' in node[3]:
+            return None
+        name, value = node[1], _unescape(node[3]).lower()
+        if name in ('entrydn', 'distinguishedname'):
+            if self.entries.has_key(value):
+                return [value]
+            return []
+        if name == 'objectclass':
+            return None
+        return self.__index(name).get(value, [])
+
+    def __index(self, name):
+        if not self.__indexes.has_key(name):
+            index = {}
+            for (key, (dn, attrs)) in self.entries.items():
+                for value in _values(dn, attrs, name):
+                    index.setdefault(value.lower(), []).append(key)
+            self.__indexes[name] = index
+        return self.__indexes[name]
+
+def _select(attrs, attrlist, maxvalrange=0):
+    if not attrlist:
+        attrlist = attrs.keys()
+    elif '*' in attrlist:
+        # all attributes, and the ranges asked for
+        attrlist = attrs.keys() + [name for name in attrlist if name != '*']
+    selected = {}
+    wanted = {}
+    for name in attrlist:
+        # "attr;range=low-*" or "attr;range=low-high"
+        low, high = 0, None
+        if ';range=' in name.lower():
+            name, bounds = name.split(';', 1)
+            low, high = bounds.split('=', 1)[1].split('-')
+            low = int(low)
+            if high == '*':
+                high = None
+            else:
+                high = int(high)
+        wanted[name.lower()] = (name, low, high)
+    for (name, values) in attrs.items():
+        if not wanted.has_key(name.lower()):
+            continue
+        name, low, high = wanted[name.lower()]
+        if high is None:
+            high = len(values) - 1
+        if maxvalrange:
+            high = min(high, low + maxvalrange - 1)
+        if low == 0 and high >= len(values) - 1:
+            selected[name] = values[:]
+            continue
+        end = str(high)
+        if high >= len(values) - 1:
+            end = '*'
+        selected['%s;range=%d-%s' % (name, low, end)] = values[low:high + 1]
+    return selected
+
+#
+# Search filters (RFC 4515, without extensible matches)
+#
+def _parse_filter(filterstr):
+    filterstr = filterstr.strip()
+    if not filterstr.startswith('('):
+        filterstr = '(%s)' % filterstr
+    node, pos = _parse(filterstr, 0)
+    if pos != len(filterstr):
+        raise FILTER_ERROR({'desc': 'Bad search filter', 'info': filterstr})
+    return node
+
+def _parse(s, i):
+    if s[i] != '(':
+        raise FILTER_ERROR({'desc': 'Bad search filter', 'info': s})
+    i += 1
+    if s[i] in '&|':
+        op = s[i]
+        i += 1
+        children = []
+        while s[i] == '(':
+            child, i = _parse(s, i)
+            children.append(child)
+        return (op, children), i + 1
+    if s[i] == '!':
+        child, i = _parse(s, i + 1)
+        return ('!', child), i + 1
+    j = s.index(')', i)
+    m = re.match(r'^([^=<>~]+)(>=|<=|~=|=)(.*)$', s[i:j])
+    if m is None:
+        raise FILTER_ERROR({'desc': 'Bad search filter', 'info': s})
+    attr, op, value = m.groups()
+    return ('cmp', attr.lower(), op, value), j + 1
+
+def _unescape(value):
+    return re.sub(r'\\([0-9a-fA-F]{2})',
+                  lambda m: chr(int(m.group(1), 16)), value)
+
+def _values(dn, attrs, name):
+    if name in ('entrydn', 'distinguishedname'):
+        return [dn]
+    if name == 'objectclass' and not attrs.has_key('objectClass'):
+        return ['top']
+    for (key, values) in attrs.items():
+        if key.lower() == name:
+            return values
+    return []
+
+def _match(node, dn, attrs):
+    kind = node[0]
+    if kind == '&':
+        for child in node[1]:
+            if not _match(child, dn, attrs):
+                return False
+        return True
+    if kind == '|':
+        for child in node[1]:
+            if _match(child, dn, attrs):
+                return True
+        return False
+    if kind == '!':
+        return not _match(node[1], dn, attrs)
+    name, op, value = node[1:]
+    values = _values(dn, attrs, name)
+    if op == '=' and value == '*':
+        return len(values) > 0
+    if op == '>=':
+        return len([v for v in values if v >= value]) > 0
+    if op == '<=':
+        return len([v for v in values if v <= value]) > 0
+    if '*' in value:
+        pattern = '.*'.join([re.escape(_unescape(part))
+                             for part in value.split('*')])
+        pattern = re.compile('^%s$' % pattern, re.I)
+        return len([v for v in values if pattern.match(v)]) > 0
+    value = _unescape(value).lower()
+    return len([v for v in values if v.lower() == value]) > 0
+
+def escape_filter_chars(value, escape_mode=0):
+    return ''.join([(c in '\\*()\0') and ('\\%02x' % ord(c)) or c
+                    for c in value])
+
+#
+# DNs
+#
+def str2dn(dn, flags=0):
+    if not dn:
+        return []
+    rdns = []
+    for rdn in re.split(r'(?<!\\),', dn):
+        if '=' not in rdn:
+            raise DECODING_ERROR({'desc': 'Decoding error', 'info': dn})
+        attr, value = rdn.split('=', 1)
+        rdns.append([(attr.strip(), value.strip(), 1)])
+    return rdns
+
+def dn2str(dn):
+    return ','.join(['+'.join(['%s=%s' % (attr, value)
+                               for (attr, value, flags) in rdn])
+                     for rdn in dn])
+
+#
+# Controls
+#
+class RequestControl:
+    pass
+
+class SimplePagedResultsControl(RequestControl):
+    controlType = '1.2.840.113556.1.4.319'
+
+    def __init__(self, criticality=True, size=10, cookie=''):
+        self.criticality = criticality
+        self.size = size
+        self.cookie = cookie
+
+#
+# Connections
+#
+class LDAPObject:
+    """A connection to the fake server of `directory'."""
+
+    def __init__(self, uri, directory, latency):
+        self.uri = uri
+        self.timeout = -1
+        self.__directory = directory
+        self.__latency = latency
+        self.__msgid = 0
+        self.__pending = {}
+        # (key, entries) of the paged search in progress: as with slapd,
+        # there is a single one per connection, and starting another one
+        # makes the cookies of the previous one invalid
+        self.__paged = None
+
+    def set_option(self, option, value):
+        pass
+
+    def start_tls_s(self):
+        self.__wait()
+
+    def simple_bind_s(self, who='', cred=''):
+        self.__wait()
+
+    def unbind_s(self):
+        pass
+
+    def abandon(self, msgid):
+        if self.__pending.has_key(msgid):
+            del self.__pending[msgid]
+
+    def search_s(self, base, scope, filterstr='(objectClass=*)',
+                 attrlist=None, attrsonly=0):
+        msgid = self.search_ext(base, scope, filterstr, attrlist)
+        return self.result3(msgid)[1]
+
+    def search_ext(self, base, scope, filterstr='(objectClass=*)',
+                   attrlist=None, attrsonly=0, serverctrls=None,
+                   clientctrls=None, timeout=-1, sizelimit=0):
+        directory = self.__directory
+        directory.stats['operations'] += 1
+        self.__msgid += 1
+        ready = time.time() + self.__latency
+        # the following pages of a paged search continue the first one
+        key = (base, scope, filterstr, tuple(attrlist or ()))
+        paged = [ctrl for ctrl in serverctrls or []
+                 if isinstance(ctrl, SimplePagedResultsControl)]
+        try:
+            if paged and paged[0].cookie:
+                if self.__paged is None or self.__paged[0] != key:
+                    raise PROTOCOL_ERROR({
+                        'desc': 'Protocol error',
+                        'info': 'paged results cookie is invalid'})
+                result = self.__paged[1]
+            else:
+                result = directory.search(base, scope, filterstr, attrlist,
+                                          select=False)
+                if paged:
+                    self.__paged = (key, result)
+        except LDAPError as e:
+            e.args[0]['msgid'] = self.__msgid
+            self.__pending[self.__msgid] = (ready, e, [])
+            return self.__msgid
+        ctrls = []
+        for ctrl in serverctrls or []:
+            if isinstance(ctrl, SimplePagedResultsControl):
+                start = int(ctrl.cookie or 0)
+                end = start + ctrl.size
+                cookie = ''
+                if end < len(result):
+                    cookie = str(end)
+                else:
+                    self.__paged = None
+                result = result[start:end]
+                ctrls.append(SimplePagedResultsControl(True, ctrl.size, cookie))
+        result = [(dn, _select(attrs, attrlist, directory.maxvalrange))
+                  for (dn, attrs) in result]
+        if directory.sizelimit and len(result) > directory.sizelimit:
+            error = SIZELIMIT_EXCEEDED({'desc': 'Size limit exceeded',
+                                        'msgid': self.__msgid})
+            self.__pending[self.__msgid] = (ready, error, [])
+            return self.__msgid
+        directory.stats['entries'] += len(result)
+        for (dn, attrs) in result:
+            for values in attrs.values():
+                directory.stats['values'] += len(values)
+        self.__pending[self.__msgid] = (ready, result, ctrls)
+        return self.__msgid
+
+    def result3(self, msgid=RES_ANY, all=1, timeout=None):
+        return self.result4(msgid, all, timeout)[:4]
+
+    def result4(self, msgid=RES_ANY, all=1, timeout=None, add_ctrls=0,
+                add_intermediates=0, add_extop=0, resp_ctrl_classes=None):
+        if msgid == RES_ANY:
+            if not self.__pending:
+                raise LDAPError({'desc': 'No outstanding operation'})
+            msgid = min([(ready, msgid) for (msgid, (ready, result, ctrls))
+                         in self.__pending.items()])[1]
+        ready, result, ctrls = self.__pending[msgid]
+        delay = ready - time.time()
+        if timeout is not None and timeout >= 0 and delay > timeout:
+            time.sleep(timeout)
+            raise TIMEOUT({'desc': 'Timed out'})
+        if delay > 0:
+            time.sleep(delay)
+        if isinstance(result, LDAPError):
+            del self.__pending[msgid]
+            raise result
+        if not all and result:
+            entry = result.pop(0)
+            if add_ctrls:
+                entry = entry + ([],)
+            return RES_SEARCH_ENTRY, [entry], msgid, [], None, None
+        del self.__pending[msgid]
+        if add_ctrls:
+            result = [entry + ([],) for entry in result]
+        return RES_SEARCH_RESULT, result, msgid, ctrls, None, None
+
+    def __wait(self):
+        if self.__latency:
+            time.sleep(self.__latency)
+
+#
+# Installation as the "ldap" module
+#
+def install(directory, latency=0.0):
+    """Make "import ldap" return a stand-in serving `directory'."""
+    this = sys.modules[__name__]
+    modules = {}
+    for name in ('ldap', 'ldap.dn', 'ldap.filter', 'ldap.controls'):
+        modules[name] = types.ModuleType(name)
+    for name in ('SCOPE_BASE', 'SCOPE_ONELEVEL', 'SCOPE_SUBTREE', 'RES_ANY',
+                 'RES_SEARCH_ENTRY', 'RES_SEARCH_RESULT',
+                 'RES_SEARCH_REFERENCE', 'RES_INTERMEDIATE', 'OPT_TIMEOUT',
+                 'OPT_NETWORK_TIMEOUT', 'OPT_REFERRALS', 'LDAPError',
+                 'SERVER_DOWN', 'CONNECT_ERROR', 'TIMEOUT', 'NO_SUCH_OBJECT',
+                 'PROTOCOL_ERROR', 'FILTER_ERROR', 'DECODING_ERROR',
+                 'SIZELIMIT_EXCEEDED', 'UNAVAILABLE_CRITICAL_EXTENSION',
+                 '__version__'):
+        setattr(modules['ldap'], name, getattr(this, name))
+    modules['ldap'].initialize = \
+        lambda uri, trace_level=0: LDAPObject(uri, directory, latency)
+    modules['ldap'].dn = modules['ldap.dn']
+    modules['ldap'].filter = modules['ldap.filter']
+    modules['ldap'].controls = modules['ldap.controls']
+    modules['ldap.dn'].str2dn = str2dn
+    modules['ldap.dn'].dn2str = dn2str
+    modules['ldap.filter'].escape_filter_chars = escape_filter_chars
+    modules['ldap.controls'].RequestControl = RequestControl
+    modules['ldap.controls'].SimplePagedResultsControl = \
+        SimplePagedResultsControl
+    sys.modules.update(modules)
+    # no ldap.syncrepl: content synchronization is not available
+    sys.modules['ldap.syncrepl'] = None